@@ -10,11 +10,30 @@ Usage:
 """
 
 import os
+import functools
+from collections import Counter
 import pandas as pd
 from inference import EmailClassifier
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # optional: faster CSV writes and Parquet output
+    pa = None
 from typing import List, Dict, Any
 
-def classify_single_email():
+MODEL_PATH = "./email_classification_model"
+CSV_CHUNK_SIZE = 1024
+
+@functools.lru_cache(maxsize=1)
+def get_classifier() -> EmailClassifier:
+    """
+    Load the classifier once and reuse it across menu actions
+    """
+    return EmailClassifier(MODEL_PATH)
+
+def classify_single_email(classifier: EmailClassifier):
     """
     Classify a single email by manual input
     """
@@ -40,10 +59,10 @@ def classify_single_email():
         print("No email content provided!")
         return
     
-    # Load classifier and predict
+    # Predict
     try:
-        classifier = EmailClassifier("./email_classification_model")
-        result = classifier.predict(subject, body)
+        # One forward pass gives both the top categories and the full distribution
+        result = classifier.predict_full(subject, body)
         
         if result['success']:
             print(f"\n📧 EMAIL CLASSIFICATION RESULTS:")
@@ -57,7 +76,7 @@ def classify_single_email():
                 print(f"     Confidence: {pred['confidence']:.1%} {confidence_bar}")
             
             print(f"\n📊 ALL CATEGORY PROBABILITIES:")
-            all_probs = classifier.get_category_probabilities(subject, body)
+            all_probs = result['all_probabilities']
             
             # Show top 8 categories
             for i, (category, prob) in enumerate(list(all_probs.items())[:8], 1):
@@ -71,10 +90,9 @@ def classify_single_email():
             print(f"❌ Error in classification: {result['error']}")
             
     except Exception as e:
-        print(f"❌ Error loading model: {str(e)}")
-        print("Make sure the model is trained and saved in ./email_classification_model/")
+        print(f"❌ Error in classification: {str(e)}")
 
-def classify_from_csv():
+def classify_from_csv(classifier: EmailClassifier):
     """
     Classify emails from a CSV file
     """
@@ -96,82 +114,74 @@ def classify_from_csv():
         print("\"Sale notification\",\"50% off all products today only!\"")
         return
     
+    output_format = input("Output format - csv or parquet (press Enter for csv): ").strip().lower() or 'csv'
+    if output_format not in ('csv', 'parquet'):
+        print(f"❌ Unknown output format: {output_format}")
+        return
+    if output_format == 'parquet' and pa is None:
+        print("❌ Parquet output needs pyarrow (pip install pyarrow)")
+        return
+    
     try:
-        # Load CSV
-        df = pd.read_csv(csv_path)
-        print(f"📁 Loaded {len(df)} emails from {csv_path}")
-        
-        # Check required columns
-        if 'subject' not in df.columns:
+        # Check required columns from the header only
+        columns = pd.read_csv(csv_path, nrows=0).columns
+        if 'subject' not in columns:
             print("❌ Missing 'subject' column in CSV")
             return
-        if 'body' not in df.columns:
+        if 'body' not in columns:
             print("❌ Missing 'body' column in CSV")
             return
         
-        # Load classifier
-        classifier = EmailClassifier("./email_classification_model")
-        
-        # Prepare emails for batch processing
-        emails = []
-        for _, row in df.iterrows():
-            emails.append({
-                'subject': str(row['subject']) if pd.notna(row['subject']) else '',
-                'body': str(row['body']) if pd.notna(row['body']) else ''
-            })
-        
-        print(f"🔄 Classifying {len(emails)} emails...")
-        
-        # Batch prediction
-        results = classifier.predict_batch(emails)
-        
-        # Process results
-        classified_data = []
-        for i, (email, result) in enumerate(zip(emails, results)):
-            if result['success']:
-                row_data = {
-                    'email_id': i + 1,
-                    'subject': email['subject'],
-                    'body': email['body'][:200] + '...' if len(email['body']) > 200 else email['body'],
-                    'category_1': result['predictions'][0]['category'] if len(result['predictions']) > 0 else 'unknown',
-                    'confidence_1': result['predictions'][0]['confidence'] if len(result['predictions']) > 0 else 0.0,
-                    'category_2': result['predictions'][1]['category'] if len(result['predictions']) > 1 else 'unknown',
-                    'confidence_2': result['predictions'][1]['confidence'] if len(result['predictions']) > 1 else 0.0,
-                }
-            else:
-                row_data = {
-                    'email_id': i + 1,
-                    'subject': email['subject'],
-                    'body': email['body'][:200] + '...' if len(email['body']) > 200 else email['body'],
-                    'category_1': 'error',
-                    'confidence_1': 0.0,
-                    'category_2': 'error',
-                    'confidence_2': 0.0,
-                }
-            classified_data.append(row_data)
-        
-        # Create results DataFrame
-        results_df = pd.DataFrame(classified_data)
-        
-        # Save results
         output_path = f"classified_{os.path.basename(csv_path)}"
-        results_df.to_csv(output_path, index=False)
+        if output_format == 'parquet':
+            output_path = os.path.splitext(output_path)[0] + '.parquet'
+        total = 0
+        category_counts = Counter()
+        samples = []
         
+        # Stream the CSV: each chunk is classified and appended to the output,
+        # so memory stays O(chunk) and the first rows are written immediately
+        print(f"🔄 Classifying emails from {csv_path} in chunks of {CSV_CHUNK_SIZE}...")
+        reader = pd.read_csv(
+            csv_path,
+            usecols=['subject', 'body'],
+            dtype={'subject': 'string', 'body': 'string'},
+            engine='c',
+            chunksize=CSV_CHUNK_SIZE,
+        )
+        with ResultWriter(output_path, output_format) as writer:
+            for chunk in reader:
+                # Prepare emails for batch processing (column-wise, no per-row pandas access)
+                subjects = chunk['subject'].fillna('').astype(str).to_numpy()
+                bodies = chunk['body'].fillna('').astype(str).to_numpy()
+                emails = [{'subject': s, 'body': b} for s, b in zip(subjects, bodies)]
+                
+                # Batch prediction
+                results = classifier.predict_batch(emails)
+                
+                rows = build_rows(emails, results, start_id=total + 1)
+                writer.write(pd.DataFrame(rows))
+                
+                total += len(rows)
+                category_counts.update(row['category_1'] for row in rows)
+                if len(samples) < 5:
+                    samples.extend(rows[:5 - len(samples)])
+                print(f"   ... {total} emails classified")
+        
+        print(f"📁 Classified {total} emails from {csv_path}")
         print(f"✅ Classification completed!")
         print(f"📄 Results saved to: {output_path}")
         
         # Show summary
         print(f"\n📊 CLASSIFICATION SUMMARY:")
-        category_counts = results_df['category_1'].value_counts()
         print(f"Most common categories:")
-        for i, (category, count) in enumerate(category_counts.head(10).items(), 1):
+        for i, (category, count) in enumerate(category_counts.most_common(10), 1):
             print(f"  {i:2d}. {category:25} ({count} emails)")
         
         # Show some examples
         print(f"\n📧 SAMPLE RESULTS:")
-        for i in range(min(5, len(results_df))):
-            row = results_df.iloc[i]
-            print(f"\nEmail {i+1}:")
+        for i, row in enumerate(samples, 1):
+            print(f"\nEmail {i}:")
             print(f"  Subject: {row['subject']}")
             print(f"  Top category: {row['category_1']} ({row['confidence_1']:.1%})")
             print(f"  2nd category: {row['category_2']} ({row['confidence_2']:.1%})")
@@ -179,7 +189,79 @@ def classify_from_csv():
     except Exception as e:
         print(f"❌ Error processing CSV: {str(e)}")
 
-def classify_from_text_input():
+class ResultWriter:
+    """
+    Append classified chunks to a CSV or Parquet file
+    
+    With pyarrow installed, CSV is written by Arrow's multi-threaded C++ writer
+    and Parquet output appends one zstd-compressed row group per chunk;
+    otherwise CSV falls back to pandas.to_csv.
+    """
+    
+    def __init__(self, output_path: str, output_format: str = 'csv'):
+        self.output_path = output_path
+        self.output_format = output_format
+        self._writer = None
+        self._schema = None
+        self._file = None
+    
+    def __enter__(self):
+        if self.output_format == 'csv' and pa is None:
+            self._file = open(self.output_path, 'w', newline='', encoding='utf-8')
+        return self
+    
+    def write(self, df: pd.DataFrame):
+        if self._file is not None:
+            df.to_csv(self._file, header=(self._file.tell() == 0), index=False)
+            return
+        table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema
+            if self.output_format == 'parquet':
+                self._writer = pq.ParquetWriter(self.output_path, self._schema, compression='zstd')
+            else:
+                self._writer = pa_csv.CSVWriter(self.output_path, self._schema)
+        self._writer.write_table(table)
+    
+    def __exit__(self, *exc):
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        return False
+
+def build_rows(emails: List[Dict[str, str]], results: List[Dict[str, Any]], start_id: int = 1) -> List[Dict[str, Any]]:
+    """
+    Turn predict_batch results into output CSV rows
+    """
+    rows = []
+    for i, (email, result) in enumerate(zip(emails, results), start_id):
+        body = email['body'][:200] + '...' if len(email['body']) > 200 else email['body']
+        if result['success']:
+            preds = result['predictions']
+            row_data = {
+                'email_id': i,
+                'subject': email['subject'],
+                'body': body,
+                'category_1': preds[0]['category'] if len(preds) > 0 else 'unknown',
+                'confidence_1': preds[0]['confidence'] if len(preds) > 0 else 0.0,
+                'category_2': preds[1]['category'] if len(preds) > 1 else 'unknown',
+                'confidence_2': preds[1]['confidence'] if len(preds) > 1 else 0.0,
+            }
+        else:
+            row_data = {
+                'email_id': i,
+                'subject': email['subject'],
+                'body': body,
+                'category_1': 'error',
+                'confidence_1': 0.0,
+                'category_2': 'error',
+                'confidence_2': 0.0,
+            }
+        rows.append(row_data)
+    return rows
+
+def classify_from_text_input(classifier: EmailClassifier):
     """
     Classify multiple emails from text input
     """
@@ -213,9 +295,6 @@ def classify_from_text_input():
         return
     
     try:
-        # Load classifier
-        classifier = EmailClassifier("./email_classification_model")
-        
         print(f"\n🔄 Classifying {len(emails)} emails...")
         
         # Classify emails
@@ -273,22 +352,28 @@ def create_sample_csv():
     print("📄 Created sample_emails.csv with 5 example emails")
     print("You can use this file to test CSV classification!")
 
-def show_available_categories():
+def show_available_categories(classifier: EmailClassifier):
     """
     Show all available categories from the trained model
     """
+    categories = classifier.get_available_categories()
+    
+    print(f"\n📋 AVAILABLE CATEGORIES ({len(categories)} total):")
+    print("="*50)
+    
+    for i, category in enumerate(categories, 1):
+        print(f"  {i:2d}. {category}")
+
+def load_classifier_or_report():
+    """
+    Return the cached classifier, or None after printing a load error
+    """
     try:
-        classifier = EmailClassifier("./email_classification_model")
-        categories = classifier.get_available_categories()
-        
-        print(f"\n📋 AVAILABLE CATEGORIES ({len(categories)} total):")
-        print("="*50)
-        
-        for i, category in enumerate(categories, 1):
-            print(f"  {i:2d}. {category}")
-        
+        return get_classifier()
     except Exception as e:
-        print(f"❌ Error loading categories: {str(e)}")
+        print(f"❌ Error loading model: {str(e)}")
+        print(f"Make sure the model is trained and saved in {MODEL_PATH}/")
+        return None
 
 def main():
     """
@@ -309,14 +394,18 @@ def main():
         
         choice = input(f"\nEnter your choice (1-6): ").strip()
         
-        if choice == '1':
-            classify_single_email()
-        elif choice == '2':
-            classify_from_csv()
-        elif choice == '3':
-            classify_from_text_input()
-        elif choice == '4':
-            show_available_categories()
+        if choice in ('1', '2', '3', '4'):
+            classifier = load_classifier_or_report()
+            if classifier is None:
+                continue
+            if choice == '1':
+                classify_single_email(classifier)
+            elif choice == '2':
+                classify_from_csv(classifier)
+            elif choice == '3':
+                classify_from_text_input(classifier)
+            else:
+                show_available_categories(classifier)
         elif choice == '5':
             create_sample_csv()
         elif choice == '6':
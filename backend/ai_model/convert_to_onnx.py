@@ -0,0 +1,78 @@
+"""
+ONNX Runtime Export Script
+==========================
+
+One-off conversion of the fine-tuned classifier to ONNX with dynamic INT8
+quantization. EmailClassifier picks the exported file up automatically when it
+is present in the model directory and serves it through ONNX Runtime with all
+graph optimizations enabled (LayerNorm/GELU/MatMul fusion, int8 MatMul on CPU).
+
+Requirements:
+- optimum[onnxruntime]>=1.16.0
+
+Usage:
+    python convert_to_onnx.py [model_path]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+ONNX_FILE_NAME = "model.onnx"
+QUANTIZED_ONNX_FILE_NAME = "model_quantized.onnx"
+
+
+def convert_to_onnx(model_path: str = "./email_classification_model", quantize: bool = True) -> str:
+    """
+    Export the model in model_path to ONNX and optionally quantize it to INT8
+
+    Args:
+        model_path: Path to the saved model directory (also the output directory)
+        quantize: Apply dynamic INT8 quantization (AVX512-VNNI config)
+
+    Returns:
+        Path of the ONNX file that EmailClassifier will load
+    """
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    print(f"Exporting {model_path} to ONNX...")
+    ort_model = ORTModelForSequenceClassification.from_pretrained(model_path, export=True)
+
+    # Export into a scratch directory so config/tokenizer files in model_path are untouched
+    with tempfile.TemporaryDirectory() as export_dir:
+        ort_model.save_pretrained(export_dir)
+        shutil.copyfile(os.path.join(export_dir, ONNX_FILE_NAME), os.path.join(model_path, ONNX_FILE_NAME))
+
+        if not quantize:
+            output = os.path.join(model_path, ONNX_FILE_NAME)
+            print(f"Saved {output}")
+            return output
+
+        print("Applying dynamic INT8 quantization...")
+        quantizer = ORTQuantizer.from_pretrained(export_dir, file_name=ONNX_FILE_NAME)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=export_dir, quantization_config=qconfig)
+        shutil.copyfile(
+            os.path.join(export_dir, QUANTIZED_ONNX_FILE_NAME),
+            os.path.join(model_path, QUANTIZED_ONNX_FILE_NAME),
+        )
+
+    output = os.path.join(model_path, QUANTIZED_ONNX_FILE_NAME)
+    print(f"Saved {output}")
+    return output
+
+
+def main():
+    model_path = sys.argv[1] if len(sys.argv) > 1 else "./email_classification_model"
+    try:
+        convert_to_onnx(model_path)
+    except ImportError:
+        print("optimum[onnxruntime] is not installed. Install it with: pip install optimum[onnxruntime]")
+    except Exception as e:
+        print(f"Error: {str(e)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,38 +16,60 @@ Usage:
 import os
 import json
 import gc
+import time
+import queue
+import threading
+import contextlib
+import logging
+from concurrent.futures import Future
 import torch
-import numpy as np
 from typing import Dict, List, Any, Optional
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import warnings
 
 warnings.filterwarnings('ignore')
 
+logger = logging.getLogger(__name__)
+
+# TorchScript artifact of the INT8-quantized model, written beside the HF weights
+TRACED_INT8_FILE = 'model_int8_traced.pt'
+
+# Body characters kept per token of max_length (WordPiece averages ~4 chars/token)
+BODY_CHARS_PER_TOKEN = 16
+
 class EmailClassifier:
     """
     Production-ready email classifier for inference
     """
     
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, int8: Optional[bool] = None):
         """
         Initialize the email classifier
         
         Args:
             model_path: Path to the saved model directory
+            int8: Apply dynamic INT8 quantization to Linear layers when running on CPU.
+                  Defaults to the MODEL_INT8 env var (enabled unless set to "0").
         """
         self.model_path = model_path
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model = None
         self.tokenizer = None
         self.label_mapping = None
-        self.reverse_mapping = None
+        self.id2label: List[str] = []
         self.categories = None
         # configurable max sequence length (default 256 on servers, 512 locally if set)
         try:
             self.max_length = max(64, min(512, int(os.getenv("MAX_SEQ_LEN", "256"))))
         except Exception:
             self.max_length = 256
+        if int8 is None:
+            int8 = os.getenv("MODEL_INT8", "1").strip().lower() not in ("0", "false", "no")
+        self.int8 = bool(int8)
+        self.quantized = False
+        self.amp_dtype: Optional[torch.dtype] = None
+        self.backend = 'torch'
+        self.compiled = False
         
         self._load_model()
     
@@ -60,190 +82,458 @@ class EmailClassifier:
                 metadata = json.load(f)
             
             self.label_mapping = metadata['label_mapping']
-            self.reverse_mapping = {v: k for k, v in self.label_mapping.items()}
+            # Class id -> label as a contiguous list (model output order)
+            self.id2label = [None] * len(self.label_mapping)
+            for label, idx in self.label_mapping.items():
+                self.id2label[idx] = label
             self.categories = metadata['categories']
+            if self.categories == self.id2label:
+                self.categories = self.id2label
             
             # Load tokenizer and model
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
-            self.model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
-            self.model.to(self.device)
-            self.model.eval()
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_path, use_fast=True)
+            onnx_file = self._find_onnx_file()
+            if onnx_file is not None:
+                # Exported by convert_to_onnx.py; exposes .logits like the PyTorch model
+                self.model = self._load_onnx_model(onnx_file)
+                self.backend = 'onnx'
+                self.quantized = 'quantized' in onnx_file
+            elif self._load_traced_int8():
+                # Quantized + traced artifact from a previous run; skips HF load and quantization
+                pass
+            else:
+                self.model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
+                self.model.to(self.device)
+                self.model.eval()
+                
+                # CPU inference is bandwidth-bound on the Linear weights; INT8 weights
+                # move 4x fewer bytes and use int8 GEMM kernels. GPU stays FP32.
+                if self.int8 and self.device.type == 'cpu':
+                    self.model = torch.quantization.quantize_dynamic(
+                        self.model, {torch.nn.Linear}, dtype=torch.qint8
+                    )
+                    self.quantized = True
+                    self._save_traced_int8()
+                
+                self._maybe_compile()
+            
+            self.amp_dtype = self._select_amp_dtype()
+            self._warmup()
             
             # Force garbage collection after model loading
             gc.collect()
             
             print(f"Model loaded successfully from {self.model_path}")
             print(f"Available categories: {len(self.categories)}")
-            print(f"Using device: {self.device}")
+            print(f"Using device: {self.device} ({self.backend}{', int8' if self.quantized else ''}{', compiled' if self.compiled else ''})")
+            if self.amp_dtype is not None:
+                print(f"Autocast dtype: {self.amp_dtype}")
             
         except Exception as e:
             raise Exception(f"Failed to load model: {str(e)}")
     
-    def predict(self, subject: str, body: str, top_k: int = 2) -> Dict[str, Any]:
+    def _use_traced_cache(self) -> bool:
+        return (
+            self.int8
+            and self.device.type == 'cpu'
+            and os.getenv("MODEL_TRACE_CACHE", "1").strip().lower() not in ("0", "false", "no")
+        )
+    
+    def _traced_int8_path(self) -> str:
+        return os.path.join(self.model_path, TRACED_INT8_FILE)
+    
+    def _load_traced_int8(self) -> bool:
+        """Load the TorchScript INT8 model saved by an earlier run, if it is still current"""
+        if not self._use_traced_cache():
+            return False
+        path = self._traced_int8_path()
+        if not os.path.exists(path):
+            return False
+        # Stale if the HF weights/config were replaced after the trace was saved
+        weights_mtime = max(
+            (os.path.getmtime(os.path.join(self.model_path, name))
+             for name in ('model.safetensors', 'pytorch_model.bin', 'config.json')
+             if os.path.exists(os.path.join(self.model_path, name))),
+            default=0.0,
+        )
+        if os.path.getmtime(path) < weights_mtime:
+            return False
+        try:
+            self.model = torch.jit.load(path, map_location=self.device)
+            self.model.eval()
+        except Exception as e:
+            print(f"Ignoring unreadable {TRACED_INT8_FILE}: {str(e)}")
+            return False
+        self.backend = 'torchscript'
+        self.quantized = True
+        return True
+    
+    def _save_traced_int8(self):
+        """Trace the freshly quantized model and save it beside the HF weights.
+        
+        Compile once, deploy many times: later processes load this file directly.
+        The trace is checked against the eager model on a different batch size and
+        sequence length before it is persisted.
         """
-        Predict categories for an email
+        if not self._use_traced_cache():
+            return
+        try:
+            example = dict(self.tokenizer(["trace example"] * 2, padding='max_length', max_length=32, return_tensors='pt'))
+            check = dict(self.tokenizer(["a longer sentence to validate the traced graph"], padding='max_length', max_length=48, return_tensors='pt'))
+            with torch.no_grad():
+                traced = torch.jit.trace(self.model, example_kwarg_inputs=example, strict=False)
+                if not torch.allclose(self._logits(traced(**check)), self._logits(self.model(**check)), atol=1e-4):
+                    print("Traced INT8 model does not match eager output; not saving it")
+                    return
+            torch.jit.save(traced, self._traced_int8_path())
+            print(f"Saved traced INT8 model to {self._traced_int8_path()}")
+        except Exception as e:
+            print(f"Could not save traced INT8 model: {str(e)}")
+    
+    @staticmethod
+    def _logits(outputs):
+        """Logits from HF/ORT model outputs or a traced module's dict/tuple output"""
+        if hasattr(outputs, 'logits'):
+            return outputs.logits
+        if isinstance(outputs, dict):
+            return outputs['logits']
+        return outputs[0]
+    
+    def _maybe_compile(self):
+        """Wrap the model with torch.compile when MODEL_COMPILE=1 (PyTorch 2.x).
+        
+        Fuses attention/GELU kernels and removes per-op Python dispatch. Opt-in
+        because the first compilation costs tens of seconds and extra memory at
+        startup; dynamic=True covers the variable bucketed sequence lengths. The
+        eager model is kept so a failing compile can be undone.
+        """
+        if os.getenv("MODEL_COMPILE", "0").strip().lower() not in ("1", "true", "yes"):
+            return
+        if not hasattr(torch, 'compile'):
+            return
+        try:
+            self._eager_model = self.model
+            self.model = torch.compile(self.model, mode='reduce-overhead', dynamic=True)
+            self.compiled = True
+        except Exception as e:
+            print(f"torch.compile unavailable, using eager model: {str(e)}")
+    
+    def _warmup(self):
+        """Run one dummy forward so the first request does not pay for allocator
+        warm-up, kernel selection or torch.compile tracing. A compiled model
+        that fails here is swapped back to its eager version."""
+        dummy = self.tokenizer("warmup", padding='max_length', max_length=64, return_tensors='pt')
+        dummy = self._to_device(dummy)
+        try:
+            with torch.inference_mode(), self._autocast():
+                self.model(**dummy)
+        except Exception as e:
+            if self.compiled:
+                print(f"torch.compile warm-up failed, using eager model: {str(e)}")
+                self.model = self._eager_model
+                self.compiled = False
+            else:
+                print(f"Warm-up forward failed: {str(e)}")
+    
+    def _find_onnx_file(self) -> Optional[str]:
+        """Return the exported ONNX file to serve, preferring the INT8 one.
+        
+        ONNX Runtime is used only when optimum[onnxruntime] is installed; set
+        MODEL_ONNX=0 to force the PyTorch model.
+        """
+        if os.getenv("MODEL_ONNX", "1").strip().lower() in ("0", "false", "no"):
+            return None
+        for name in ("model_quantized.onnx", "model.onnx"):
+            if os.path.exists(os.path.join(self.model_path, name)):
+                try:
+                    import optimum.onnxruntime  # noqa: F401
+                except ImportError:
+                    print("ONNX model found but optimum[onnxruntime] is not installed; using PyTorch")
+                    return None
+                return name
+        return None
+    
+    def _load_onnx_model(self, file_name: str):
+        """Load an ONNX Runtime session with all graph optimizations enabled"""
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        provider = 'CUDAExecutionProvider' if self.device.type == 'cuda' else 'CPUExecutionProvider'
+        return ORTModelForSequenceClassification.from_pretrained(
+            self.model_path,
+            file_name=file_name,
+            provider=provider,
+            session_options=session_options,
+        )
+    
+    def _select_amp_dtype(self) -> Optional[torch.dtype]:
+        """Pick the half-precision autocast dtype for this device (None = FP32).
+        
+        BF16 needs no retraining for BERT-style encoders. Disabled with MODEL_AMP=0
+        and skipped for INT8-quantized models, whose Linear kernels take FP32 input.
+        """
+        if self.backend != 'torch' or os.getenv("MODEL_AMP", "1").strip().lower() in ("0", "false", "no"):
+            return None
+        try:
+            if self.device.type == 'cuda':
+                return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            if self.quantized:
+                return None
+            if torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported():
+                return torch.bfloat16
+        except Exception:
+            pass
+        return None
+    
+    def _autocast(self):
+        """Autocast context for the forward pass, or a no-op when running FP32"""
+        if self.amp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype)
+    
+    def _compose_text(self, subject: str, body: str) -> str:
+        """
+        Build the model input the way the model was trained: "subject body"
+        
+        The body is clipped to a character window that comfortably covers
+        max_length tokens before concatenating, so very long bodies are not
+        copied in full only for the tokenizer to truncate them.
+        """
+        body = body or ''
+        limit = self.max_length * BODY_CHARS_PER_TOKEN
+        if len(body) > limit:
+            body = body[:limit]
+        return f"{subject or ''} {body}".strip()
+    
+    def _to_device(self, inputs) -> Dict[str, torch.Tensor]:
+        """Move tokenizer output to the model device.
+        
+        On CUDA the tensors are staged in pinned memory and copied with
+        non_blocking=True, so the H2D copy overlaps with queued kernels.
+        """
+        if self.device.type == 'cuda':
+            return {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in inputs.items()}
+        return {k: v.to(self.device) for k, v in inputs.items()}
+    
+    def _tokenize_one(self, text: str):
+        """Tokenize a single text to tensors; a lone sequence never needs padding"""
+        return self.tokenizer(
+            text,
+            truncation=True,
+            padding=False,
+            max_length=self.max_length,
+            return_tensors='pt'
+        )
+    
+    def _tokenize_many(self, texts: List[str]):
+        """Tokenize many texts in one call, unpadded (predict_batch pads per length bucket)"""
+        return self.tokenizer(
+            texts,
+            truncation=True,
+            padding=False,
+            max_length=self.max_length
+        )
+    
+    def _forward_probabilities(self, subject: str, body: str):
+        """
+        Tokenize one email and run a single forward pass
         
-        Args:
-            subject: Email subject line
-            body: Email body content
-            top_k: Number of top categories to return (default: 2)
-            
         Returns:
-            Dictionary containing predictions and confidence scores
+            Tuple of (input text, 1-D float32 probability tensor on the model device)
+        """
+        # Prepare input text
+        full_text = self._compose_text(subject, body)
+        
+        # Tokenize input
+        inputs = self._tokenize_one(full_text)
+        
+        # Move inputs to device
+        inputs = self._to_device(inputs)
+        
+        # Get predictions
+        with torch.inference_mode(), self._autocast():
+            logits = self._logits(self.model(**inputs))
+        
+        # Apply sigmoid to get probabilities
+        return full_text, torch.sigmoid(logits).squeeze(0).float()
+    
+    def _build_result(self, text: str, top_indices: List[int], top_values: List[float]) -> Dict[str, Any]:
+        """Assemble the public prediction dict from host-side top-k indices/values"""
+        top_categories = [self.id2label[i] for i in top_indices]
+        return {
+            'input_text': text,
+            'top_categories': top_categories,
+            'confidences': top_values,
+            'predictions': [
+                {'category': c, 'confidence': p}
+                for c, p in zip(top_categories, top_values)
+            ],
+            'success': True,
+            # Top 2 categories for backward compatibility
+            'top_2_categories': top_categories[:2],
+        }
+    
+    def _predict_one(self, subject: str, body: str, top_k: int, with_probabilities: bool) -> Dict[str, Any]:
+        """
+        Shared single-email path for predict() and predict_full()
+        
+        Top-k selection runs on the device, so only top_k values and indices are
+        copied back; the full probability vector is transferred only when
+        with_probabilities is requested.
         """
         try:
-            # Prepare input text
-            full_text = f"{subject} {body}".strip()
-            
-            # Tokenize input
-            inputs = self.tokenizer(
-                full_text,
-                truncation=True,
-                padding=True,
-                max_length=self.max_length,
-                return_tensors='pt'
-            )
+            full_text, probs = self._forward_probabilities(subject, body)
             
-            # Move inputs to device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            # Get top k categories (O(C) partial selection instead of a full sort)
+            top_values, top_indices = torch.topk(probs, k=min(top_k, probs.numel()))
+            result = self._build_result(full_text, top_indices.tolist(), top_values.tolist())
             
-            # Get predictions
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                logits = outputs.logits
-            
-            # Apply sigmoid to get probabilities
-            probabilities = torch.sigmoid(logits).squeeze().cpu().numpy()
-            
-            # Get top k categories
-            top_indices = np.argsort(probabilities)[::-1][:top_k]
-            top_categories = [self.reverse_mapping[idx] for idx in top_indices]
-            top_confidences = [float(probabilities[idx]) for idx in top_indices]
-            
-            # Create predictions list
-            predictions = []
-            for i in range(len(top_categories)):
-                predictions.append({
-                    'category': top_categories[i],
-                    'confidence': top_confidences[i]
-                })
-            
-            # Create result
-            result = {
-                'input_text': full_text,
-                'top_categories': top_categories,
-                'confidences': top_confidences,
-                'predictions': predictions,
-                'success': True
-            }
-            
-            # Add top 2 categories for backward compatibility
-            if len(top_categories) >= 2:
-                result['top_2_categories'] = top_categories[:2]
-            else:
-                result['top_2_categories'] = top_categories
+            if with_probabilities:
+                # Sort once on the device; copy to host only when building the dict
+                order = torch.argsort(probs, descending=True)
+                result['all_probabilities'] = {
+                    self.id2label[i]: p
+                    for i, p in zip(order.tolist(), probs[order].tolist())
+                }
             
             return result
             
         except Exception as e:
-            return {
+            logger.exception("Prediction failed")
+            result = {
                 'error': str(e),
-                'input_text': f"{subject} {body}".strip(),
+                'input_text': self._compose_text(subject, body),
                 'top_categories': [],
                 'confidences': [],
                 'predictions': [],
                 'success': False
             }
+            if with_probabilities:
+                result['all_probabilities'] = {}
+            return result
+    
+    def predict_full(self, subject: str, body: str, top_k: int = 2) -> Dict[str, Any]:
+        """
+        Predict top categories and all category probabilities from one forward pass
+        
+        Args:
+            subject: Email subject line
+            body: Email body content
+            top_k: Number of top categories to return (default: 2)
+            
+        Returns:
+            The predict() result dictionary plus 'all_probabilities', a mapping of
+            every category to its probability sorted from most to least likely
+        """
+        return self._predict_one(subject, body, top_k, with_probabilities=True)
     
-    def predict_batch(self, emails: List[Dict[str, str]], top_k: int = 2, batch_size: int = 5) -> List[Dict[str, Any]]:
+    def predict(self, subject: str, body: str, top_k: int = 2) -> Dict[str, Any]:
         """
-        Predict categories for multiple emails using memory-efficient batch processing
+        Predict categories for an email
+        
+        Args:
+            subject: Email subject line
+            body: Email body content
+            top_k: Number of top categories to return (default: 2)
+            
+        Returns:
+            Dictionary containing predictions and confidence scores
+        """
+        return self._predict_one(subject, body, top_k, with_probabilities=False)
+    
+    def predict_batch(self, emails: List[Dict[str, str]], top_k: int = 2, batch_size: int = 32) -> List[Dict[str, Any]]:
+        """
+        Predict categories for multiple emails using true tokenizer + model batching
+        
+        All texts are tokenized in one (Rust) call without padding, then grouped
+        into power-of-two length buckets so short emails are never padded to the
+        longest email in the request. Each sub-batch runs one forward pass and
+        top-k selection happens on the device, so only the small top-k result is
+        copied back to the host.
         
         Args:
             emails: List of dictionaries with 'subject' and 'body' keys
             top_k: Number of top categories to return for each email
-            batch_size: Number of emails to process in each sub-batch (default: 5 for memory efficiency)
+            batch_size: Number of emails to process in each sub-batch (bounds peak memory);
+                halved and retried when a sub-batch fails (e.g. out of memory)
             
         Returns:
-            List of prediction results
+            List of prediction results (same order as emails)
         """
         if not emails:
             return []
         
+        # Prepare all texts once
+        full_texts = [self._compose_text(email.get('subject', ''), email.get('body', '')) for email in emails]
+        k = min(top_k, len(self.categories))
+        batch_size = max(1, int(batch_size))
+        
         try:
-            all_results = []
-            
-            # Process in smaller sub-batches to avoid memory issues on Render
-            for i in range(0, len(emails), batch_size):
-                batch = emails[i:i + batch_size]
-                
-                # Prepare texts for this sub-batch
-                full_texts = [f"{email.get('subject', '')} {email.get('body', '')}".strip() for email in batch]
-                
-                # Tokenize this sub-batch
-                inputs = self.tokenizer(
-                    full_texts,
-                    truncation=True,
-                    padding=True,
-                    max_length=self.max_length,
-                    return_tensors='pt'
-                )
-                
-                # Move inputs to device
-                inputs = {k: v.to(self.device) for k, v in inputs.items()}
-                
-                # Get predictions for this sub-batch
-                with torch.no_grad():
-                    outputs = self.model(**inputs)
-                    logits = outputs.logits
-                
-                # Apply sigmoid to get probabilities
-                probabilities = torch.sigmoid(logits).cpu().numpy()
-                
-                # Clear GPU/CPU cache after each batch
-                del outputs, logits, inputs
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                gc.collect()  # Force Python garbage collection
-                
-                # Process results for each email in this sub-batch
-                for j, (email, probs) in enumerate(zip(batch, probabilities)):
-                    # Get top k categories for this email
-                    top_indices = np.argsort(probs)[::-1][:top_k]
-                    top_categories = [self.reverse_mapping[idx] for idx in top_indices]
-                    top_confidences = [float(probs[idx]) for idx in top_indices]
+            # Tokenize everything once, unpadded, to learn each email's length
+            encodings = self._tokenize_many(full_texts)
+            
+            # Group email indices by length bucket; attention cost is O(L^2) per row
+            buckets: Dict[int, List[int]] = {}
+            for idx, ids in enumerate(encodings['input_ids']):
+                buckets.setdefault(self._length_bucket(len(ids)), []).append(idx)
+            
+            all_results: List[Optional[Dict[str, Any]]] = [None] * len(full_texts)
+            num_batches = sum((len(idxs) + batch_size - 1) // batch_size for idxs in buckets.values())
+            batch_no = 0
+            
+            # Process each bucket in sub-batches to bound memory on Render
+            for bucket_len in sorted(buckets):
+                idxs = buckets[bucket_len]
+                for i in range(0, len(idxs), batch_size):
+                    chunk = idxs[i:i + batch_size]
                     
-                    # Create predictions list
-                    predictions = []
-                    for k_idx in range(len(top_categories)):
-                        predictions.append({
-                            'category': top_categories[k_idx],
-                            'confidence': top_confidences[k_idx]
-                        })
+                    # Pad only up to this bucket's length
+                    features = [{key: encodings[key][idx] for key in encodings.keys()} for idx in chunk]
+                    inputs = self.tokenizer.pad(
+                        features,
+                        padding='max_length',
+                        max_length=bucket_len,
+                        return_tensors='pt'
+                    )
                     
-                    # Create result
-                    result = {
-                        'input_text': full_texts[j],
-                        'top_categories': top_categories,
-                        'confidences': top_confidences,
-                        'predictions': predictions,
-                        'success': True
-                    }
+                    # Move inputs to device
+                    inputs = self._to_device(inputs)
                     
-                    # Add top 2 categories for backward compatibility
-                    if len(top_categories) >= 2:
-                        result['top_2_categories'] = top_categories[:2]
-                    else:
-                        result['top_2_categories'] = top_categories
+                    # Single forward pass for the sub-batch
+                    with torch.inference_mode(), self._autocast():
+                        logits = self._logits(self.model(**inputs))
+                        # Sigmoid + top-k on the device over the full [B, C] logits
+                        top_values, top_indices = torch.topk(torch.sigmoid(logits), k=k, dim=1)
                     
-                    all_results.append(result)
-                
-                print(f"Processed sub-batch {i//batch_size + 1}/{(len(emails)-1)//batch_size + 1} ({len(batch)} emails)")
+                    # Only the small [B, k] top-k result crosses to the host, in one copy each
+                    top_values = top_values.float().cpu().tolist()
+                    top_indices = top_indices.cpu().tolist()
+                    
+                    del logits, inputs
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                    
+                    # Build results for the whole sub-batch from the host-side lists
+                    for idx, row_indices, row_values in zip(chunk, top_indices, top_values):
+                        all_results[idx] = self._build_result(full_texts[idx], row_indices, row_values)
+                    
+                    batch_no += 1
+                    print(f"Processed sub-batch {batch_no}/{num_batches} ({len(chunk)} emails, length {bucket_len})")
             
             return all_results
             
         except Exception as e:
-            # Fallback to individual processing if batch fails
+            # Usually out of memory: halve the sub-batch and retry, keeping batching
+            if batch_size > 1:
+                print(f"Batch prediction failed: {str(e)}, retrying with batch_size={batch_size // 2}")
+                gc.collect()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                return self.predict_batch(emails, top_k=top_k, batch_size=batch_size // 2)
+            
+            # Fallback to individual processing if even single-email batches fail
             print(f"Batch prediction failed: {str(e)}, falling back to individual processing")
             results = []
             for email in emails:
@@ -254,6 +544,10 @@ class EmailClassifier:
             
             return results
     
+    def _length_bucket(self, length: int) -> int:
+        """Round a token length up to the next power of two, capped at max_length"""
+        return min(self.max_length, max(16, 1 << max(0, length - 1).bit_length()))
+    
     def get_category_probabilities(self, subject: str, body: str) -> Dict[str, float]:
         """
         Get probabilities for all categories
@@ -263,44 +557,10 @@ class EmailClassifier:
             body: Email body content
             
         Returns:
-            Dictionary mapping category names to probabilities
+            Dictionary mapping category names to probabilities (empty if prediction failed)
         """
-        try:
-            # Prepare input text
-            full_text = f"{subject} {body}".strip()
-            
-            # Tokenize input
-            inputs = self.tokenizer(
-                full_text,
-                truncation=True,
-                padding=True,
-                max_length=512,
-                return_tensors='pt'
-            )
-            
-            # Move inputs to device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
-            # Get predictions
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                logits = outputs.logits
-            
-            # Apply sigmoid to get probabilities
-            probabilities = torch.sigmoid(logits).squeeze().cpu().numpy()
-            
-            # Create probability dictionary
-            prob_dict = {}
-            for i, category in enumerate(self.categories):
-                prob_dict[category] = float(probabilities[i])
-            
-            # Sort by probability
-            prob_dict = dict(sorted(prob_dict.items(), key=lambda x: x[1], reverse=True))
-            
-            return prob_dict
-            
-        except Exception as e:
-            return {category: 0.0 for category in self.categories}
+        # Empty on failure (logged in _predict_one) rather than a zeroed distribution
+        return self.predict_full(subject, body)['all_probabilities']
     
     def get_available_categories(self) -> List[str]:
         """
@@ -311,6 +571,94 @@ class EmailClassifier:
         """
         return self.categories.copy()
 
+class BatchedEmailClassifier:
+    """
+    Dynamic request batching in front of an EmailClassifier
+    
+    Concurrent single-email predict() calls (e.g. from web request threads) are
+    queued and merged by a background worker into one predict_batch() forward
+    pass, amortizing per-forward overhead across callers. Requests that arrive
+    while a batch is running form the next batch, so an idle server adds at
+    most max_wait_ms of latency.
+    """
+    
+    def __init__(self, classifier: EmailClassifier, max_batch_size: int = 32, max_wait_ms: float = 2.0,
+                 timeout: Optional[float] = 60.0):
+        """
+        Args:
+            classifier: Loaded EmailClassifier used for the batched forward passes
+            max_batch_size: Maximum number of requests merged into one batch
+            max_wait_ms: How long to wait for more requests after the first one arrives
+            timeout: Seconds predict() waits for its batch before raising TimeoutError
+        """
+        self.classifier = classifier
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.timeout = timeout
+        self._queue: "queue.Queue" = queue.Queue()
+        # The worker thread is started on first use, and again in a forked
+        # child (threads don't survive fork(), e.g. under gunicorn --preload)
+        self._worker_pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+    
+    def predict(self, subject: str, body: str, top_k: int = 2) -> Dict[str, Any]:
+        """
+        Predict categories for an email; blocks until its batch has run
+        
+        Returns:
+            Same dictionary shape as EmailClassifier.predict()
+        
+        Raises:
+            concurrent.futures.TimeoutError: If the batch didn't finish within timeout
+        """
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put((subject, body, top_k, future))
+        return future.result(timeout=self.timeout)
+    
+    def _ensure_worker(self):
+        if self._worker_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._worker_pid != os.getpid():
+                if self._worker_pid is not None:
+                    # Inherited across fork(): the queue's locks may be in any state
+                    self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), name="email-classifier-batcher", daemon=True).start()
+                self._worker_pid = os.getpid()
+    
+    def _run(self, queue_: "queue.Queue"):
+        while True:
+            pending = [queue_.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                try:
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        pending.append(queue_.get(timeout=remaining))
+                    else:
+                        pending.append(queue_.get_nowait())
+                except queue.Empty:
+                    break
+            self._dispatch(pending)
+    
+    def _dispatch(self, pending):
+        # Requests asking for a different top_k run as separate batches
+        by_top_k: Dict[int, list] = {}
+        for item in pending:
+            by_top_k.setdefault(item[2], []).append(item)
+        
+        for top_k, items in by_top_k.items():
+            try:
+                emails = [{'subject': subject, 'body': body} for subject, body, _, _ in items]
+                results = self.classifier.predict_batch(emails, top_k=top_k, batch_size=self.max_batch_size)
+                for (_, _, _, future), result in zip(items, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
 # Standalone functions for backward compatibility
 def load_model(model_path: str) -> EmailClassifier:
     """
@@ -4,58 +4,94 @@ Gmail client helpers to fetch messages and extract full plaintext bodies.
 Functions:
 - extract_plaintext_from_message(msg_data): robust plaintext extraction from Gmail message JSON
 - get_message_plain(service, message_id): fetch message and return a normalized dict with plaintext body
+- get_messages_plain_batch(service, message_ids): same, for many messages via batched HTTP requests
+- iter_message_ids(service, ...): yield pages of message IDs as they are listed
+- fetch_messages_plain(service_factory, id_pages): batch-fetch pages of IDs concurrently on a shared thread pool
 
 Why: Classifying only snippets or raw HTML hurts model quality; we extract and clean plaintext.
 """
 from __future__ import annotations
 
-import base64
+import binascii
 import logging
+import os
 import re
-from datetime import datetime
-from typing import Any, Dict, Iterable, List, Optional
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
 
+# No-op when the app has already configured the root logger
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
 logger = logging.getLogger(__name__)
-if not logger.handlers:
-    _h = logging.StreamHandler()
-    _h.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [gmail_client] %(message)s"))
-    logger.addHandler(_h)
-logger.setLevel(logging.INFO)
+
+
+_RE_BR = re.compile(r"<\s*br\s*/?>", re.IGNORECASE)
+_RE_TAG = re.compile(r"<[^>]+>")
+_RE_WS = re.compile(r"\s+")
+_B64URL_TO_STD = bytes.maketrans(b"-_", b"+/")
 
 
 def _b64url_decode(data: str) -> bytes:
-    data = data or ""
-    data += "=" * (-len(data) % 4)
-    return base64.urlsafe_b64decode(data.encode("utf-8"))
+    # Map the URL-safe alphabet to the standard one and decode with the C-level binascii routine
+    if not data:
+        return b""
+    raw = data.encode("ascii").translate(_B64URL_TO_STD)
+    raw += b"=" * (-len(raw) & 3)
+    return binascii.a2b_base64(raw)
 
 
 def _strip_html(html: str) -> str:
     # Replace breaks with newlines, strip tags, collapse whitespace
-    text = re.sub(r"<\s*br\s*/?>", "\n", html or "", flags=re.IGNORECASE)
-    text = re.sub(r"<[^>]+>", " ", text)
-    return re.sub(r"\s+", " ", text).strip()
+    return _RE_WS.sub(" ", _RE_TAG.sub(" ", _RE_BR.sub("\n", html or ""))).strip()
 
 
-def _gather_parts(payload: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
-    # Yield payload and nested parts depth-first
+def _gather_parts(payload: Dict[str, Any], mime_prefix: Optional[str] = None) -> Iterable[Dict[str, Any]]:
+    # Yield payload and nested parts depth-first, optionally only those whose
+    # mimeType starts with mime_prefix (the whole tree is still walked)
     if not payload:
         return []
     stack: List[Dict[str, Any]] = [payload]
     while stack:
         p = stack.pop()
-        yield p
+        if mime_prefix is None or (p.get("mimeType") or "").lower().startswith(mime_prefix):
+            yield p
         parts = p.get("parts") or []
         if isinstance(parts, list):
             stack.extend(reversed(parts))
 
 
-def extract_plaintext_from_message(msg_data: Dict[str, Any]) -> str:
+def _b64_prefix_len(max_chars: int) -> int:
+    # base64 characters that cover max_chars UTF-8 characters (at most 4 bytes each)
+    return -(-max_chars * 4 // 3) * 4
+
+
+def _decode_part(part: Dict[str, Any], max_chars: Optional[int] = None) -> str:
+    # Inline body data only; attachments (body.attachmentId) would need a separate fetch.
+    # With max_chars only the base64 prefix that can hold that many characters
+    # is decoded (a multibyte character cut at the end is dropped).
+    data = (part.get("body") or {}).get("data")
+    if not data:
+        return ""
+    if max_chars is not None:
+        data = data[:_b64_prefix_len(max_chars)]
+    try:
+        return _b64url_decode(data).decode("utf-8", errors="ignore")
+    except Exception:
+        return ""
+
+
+def extract_plaintext_from_message(msg_data: Dict[str, Any], max_body_chars: Optional[int] = None) -> str:
     """Extract the best plaintext from a Gmail message JSON (format="full").
 
     Preference order:
-    1) text/plain parts (concatenate)
+    1) the first non-empty text/plain part
     2) text/html parts (stripped)
     3) fallback to any body.data decoded
+
+    HTML parts are only decoded when no text/plain part has content.
+    ``max_body_chars`` caps the returned text; text/plain bodies are then only
+    partially decoded, which saves CPU and memory on large newsletters.
     """
     if not msg_data:
         return ""
@@ -64,65 +100,76 @@ def extract_plaintext_from_message(msg_data: Dict[str, Any]) -> str:
     if not payload:
         return ""
 
-    plain_chunks: List[str] = []
-    html_chunks: List[str] = []
+    for part in _gather_parts(payload, "text/plain"):
+        text = _decode_part(part, max_body_chars).strip()
+        if text:
+            return text[:max_body_chars]
 
-    for part in _gather_parts(payload):
-        mime = (part.get("mimeType") or "").lower()
-        body = part.get("body") or {}
-        data = body.get("data")
+    html_chunks = [raw for raw in map(_decode_part, _gather_parts(payload, "text/html")) if raw]
+    if html_chunks:
+        # Combine and strip HTML (markup length says little about text length,
+        # so HTML is decoded in full and clipped afterwards)
+        return _strip_html("\n\n".join(html_chunks))[:max_body_chars]
 
-        if not data and body.get("attachmentId"):
-            # Skip attachments (we could fetch via users().messages().attachments())
-            continue
+    # Fallback: single body at root payload
+    if (payload.get("body") or {}).get("data"):
+        return _decode_part(payload, max_body_chars).strip()[:max_body_chars]
 
-        if data:
-            try:
-                raw = _b64url_decode(data).decode("utf-8", errors="ignore")
-            except Exception:
-                raw = ""
-        else:
-            raw = ""
+    return ""
 
-        if mime.startswith("text/plain") and raw:
-            plain_chunks.append(raw.strip())
-        elif mime.startswith("text/html") and raw:
-            html_chunks.append(raw)
 
-    if plain_chunks:
-        return "\n\n".join([c for c in plain_chunks if c]).strip()
+def _headers_lookup(headers: List[Dict[str, str]], wanted: Iterable[str] = ("from", "subject", "date")) -> Dict[str, str]:
+    # Single pass over the headers that stops once every wanted (lowercase) name is found
+    out: Dict[str, str] = {}
+    need = set(wanted)
+    for h in headers or ():
+        name = (h.get("name") or "").lower()
+        if name in need:
+            out[name] = h.get("value") or ""
+            need.discard(name)
+            if not need:
+                break
+    return out
 
-    if html_chunks:
-        # Combine and strip HTML
-        return _strip_html("\n\n".join(html_chunks))
 
-    # Fallback: single body at root payload
-    body_root = (payload.get("body") or {}).get("data")
-    if body_root:
-        try:
-            return _b64url_decode(body_root).decode("utf-8", errors="ignore").strip()
-        except Exception:
-            return ""
+# Gmail accepts at most 100 calls per batch request
+BATCH_LIMIT = 100
+# Retries (exponential backoff with jitter, done by googleapiclient) for 429/5xx
+# and rate-limit responses on individual requests
+NUM_RETRIES = 3
 
-    return ""
 
+# Partial response mask for messages.get: headers plus MIME type/body data of
+# up to _MASK_PART_DEPTH levels of nested parts, so base64 bodies of attachments
+# and inline images are not downloaded. Five levels cover a forwarded
+# message/rfc822 inside mixed/related/alternative; messages whose body still
+# comes back empty are refetched without the mask (get_messages_plain_batch).
+_PART_FIELDS = "mimeType,body/data,body/attachmentId"
+_MASK_PART_DEPTH = 5
 
-def _headers_to_map(headers: List[Dict[str, str]]) -> Dict[str, str]:
-    return { (h.get("name") or "").lower(): (h.get("value") or "") for h in (headers or []) }
 
+def _parts_mask(depth: int) -> str:
+    mask = _PART_FIELDS
+    for _ in range(depth - 1):
+        mask = f"{_PART_FIELDS},parts({mask})"
+    return f"parts({mask})"
 
-def get_message_plain(service: Any, message_id: str, user_id: str = "me") -> Dict[str, Any]:
-    """Fetch a Gmail message and return a normalized dict with plaintext body.
 
-    Returns: {
-      "id": str, "threadId": str, "date": ISODate, "from": str, "subject": str, "body": str
-    }
-    """
-    msg = service.users().messages().get(userId=user_id, id=message_id, format="full").execute() or {}
+MESSAGE_FIELDS = f"id,threadId,internalDate,payload(headers,{_PART_FIELDS},{_parts_mask(_MASK_PART_DEPTH)})"
+
+
+# Partial response mask for messages.list: only IDs and the paging token
+# (drops threadId and resultSizeEstimate from every listed page)
+LIST_FIELDS = "messages/id,nextPageToken"
+
+
+def _normalize_message(msg: Dict[str, Any], max_body_chars: Optional[int] = None) -> Dict[str, Any]:
+    """Turn a Gmail message JSON (format="full") into the normalized plaintext dict."""
+    msg = msg or {}
     payload = msg.get("payload") or {}
     headers = payload.get("headers") or []
 
-    hmap = _headers_to_map(headers)
+    hmap = _headers_lookup(headers)
     sender = hmap.get("from", "")
     subject = hmap.get("subject", "")
     date_header = hmap.get("date")
@@ -131,13 +178,14 @@ def get_message_plain(service: Any, message_id: str, user_id: str = "me") -> Dic
     date_iso: Optional[str] = None
     try:
         if internal_ms:
-            date_iso = datetime.utcfromtimestamp(int(internal_ms) / 1000).date().isoformat()
+            date_iso = datetime.fromtimestamp(int(internal_ms) // 1000, timezone.utc).date().isoformat()
     except Exception:
         date_iso = None
 
-    body_text = extract_plaintext_from_message(msg)
+    body_text = extract_plaintext_from_message(msg, max_body_chars)
 
-    logger.info("Fetched message %s (thread %s) len=%s subject='%s'", msg.get("id"), msg.get("threadId"), len(body_text), subject[:60])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Fetched message %s (thread %s) len=%s subject='%s'", msg.get("id"), msg.get("threadId"), len(body_text), subject[:60])
 
     return {
         "id": msg.get("id"),
@@ -150,39 +198,189 @@ def get_message_plain(service: Any, message_id: str, user_id: str = "me") -> Dic
     }
 
 
-def list_message_ids(service: Any, user_id: str = "me", q: Optional[str] = None, max_results: int = 100) -> List[str]:
-    """List up to ``max_results`` message IDs, paging with nextPageToken as needed.
+def get_message_plain(
+    service: Any,
+    message_id: str,
+    user_id: str = "me",
+    fields: Optional[str] = MESSAGE_FIELDS,
+    max_body_chars: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Fetch a Gmail message and return a normalized dict with plaintext body.
 
-    Gmail's ``messages.list`` returns a single page unless we iterate. Here we
-    keep requesting pages until we accumulate up to ``max_results`` IDs or run
-    out of pages. This enables callers to request more than the first page's
-    results (which are typically capped), avoiding duplicate top results across
-    multiple calls.
+    ``fields`` is the partial-response mask (``None`` for the whole message).
+    ``max_body_chars`` truncates the body (``None`` keeps all of it).
+
+    Returns: {
+      "id": str, "threadId": str, "date": ISODate, "from": str, "subject": str, "body": str
+    }
     """
-    ids: List[str] = []
+    msg = (
+        service.users().messages()
+        .get(userId=user_id, id=message_id, format="full", fields=fields)
+        .execute(num_retries=NUM_RETRIES)
+        or {}
+    )
+    return _normalize_message(msg, max_body_chars)
+
+
+def get_messages_plain_batch(
+    service: Any,
+    message_ids: List[str],
+    user_id: str = "me",
+    fields: Optional[str] = MESSAGE_FIELDS,
+    max_body_chars: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Fetch many messages via BatchHttpRequest and return normalized dicts.
+
+    IDs are sent in chunks of ``BATCH_LIMIT`` so each chunk costs one HTTP
+    round-trip instead of one per message. Items that fail inside a batch are
+    retried with a single ``get`` (with backoff on 429/5xx); messages that
+    still fail are skipped. Messages whose body is empty under the ``fields``
+    mask (text nested deeper than the mask reaches) are fetched again unmasked.
+    Results keep the order of ``message_ids``.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    failed: List[str] = []
+
+    def _callback(request_id: str, response: Any, exception: Optional[Exception]) -> None:
+        if exception is not None:
+            failed.append(request_id)
+            return
+        results[request_id] = _normalize_message(response, max_body_chars)
+
+    # request_id must be unique within a batch, so drop duplicate IDs
+    ids = list(dict.fromkeys(mid for mid in message_ids if mid))
+    for start in range(0, len(ids), BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=_callback)
+        for mid in ids[start:start + BATCH_LIMIT]:
+            batch.add(
+                service.users().messages().get(userId=user_id, id=mid, format="full", fields=fields),
+                request_id=mid,
+            )
+        try:
+            batch.execute()
+        except Exception:
+            logger.exception("Batch fetch failed; retrying %d messages individually", len(ids[start:start + BATCH_LIMIT]))
+            failed.extend(mid for mid in ids[start:start + BATCH_LIMIT] if mid not in results)
+
+    for mid in failed:
+        try:
+            results[mid] = get_message_plain(service, mid, user_id=user_id, fields=fields, max_body_chars=max_body_chars)
+        except Exception as e:
+            logger.warning("Failed to fetch message %s: %s", mid, e)
+
+    if fields:
+        empty = [mid for mid in ids if mid in results and not results[mid].get("body")]
+        if empty:
+            for info in get_messages_plain_batch(service, empty, user_id=user_id, fields=None, max_body_chars=max_body_chars):
+                results[info["id"]] = info
+
+    return [results[mid] for mid in ids if mid in results]
+
+
+def iter_message_ids(service: Any, user_id: str = "me", q: Optional[str] = None, max_results: int = 100) -> Iterator[List[str]]:
+    """Yield pages of message IDs (up to ``max_results`` in total) as they arrive.
+
+    Callers can start fetching bodies for one page while the next page is being
+    listed. Listing errors are logged and end the iteration early, like
+    ``list_message_ids``.
+    """
+    seen = 0
     page_token: Optional[str] = None
     # Gmail allows maxResults up to 500 per page; keep individual requests reasonable
-    remaining = max(1, int(max_results or 100))
+    max_results = max(1, int(max_results or 100))
     try:
-        while remaining > 0:
-            batch_size = min(remaining, 100)
+        while seen < max_results:
+            batch_size = min(max_results - seen, 100)
             req = (
                 service
                 .users()
                 .messages()
-                .list(userId=user_id, q=q, maxResults=batch_size, pageToken=page_token)
+                .list(userId=user_id, q=q, maxResults=batch_size, pageToken=page_token, fields=LIST_FIELDS)
             )
-            resp = req.execute() or {}
+            resp = req.execute(num_retries=NUM_RETRIES) or {}
             messages = resp.get("messages", []) or []
             if not messages:
                 break
-            ids.extend([m.get("id") for m in messages if m.get("id")])
-            if len(ids) >= max_results:
-                break
+            page = [m.get("id") for m in messages if m.get("id")][:max_results - seen]
+            seen += len(page)
+            yield page
             page_token = resp.get("nextPageToken")
             if not page_token:
                 break
-            remaining = max_results - len(ids)
     except Exception:
-        logger.exception("Failed to list message ids; returning partial results (%d)", len(ids))
-    return ids[:max_results]
+        logger.exception("Failed to list message ids; stopping after %d", seen)
+
+
+def list_message_ids(service: Any, user_id: str = "me", q: Optional[str] = None, max_results: int = 100) -> List[str]:
+    """List up to ``max_results`` message IDs, paging with nextPageToken as needed.
+
+    Gmail's ``messages.list`` returns a single page unless we iterate. Here we
+    keep requesting pages until we accumulate up to ``max_results`` IDs or run
+    out of pages. This enables callers to request more than the first page's
+    results (which are typically capped), avoiding duplicate top results across
+    multiple calls.
+    """
+    ids: List[str] = []
+    for page in iter_message_ids(service, user_id=user_id, q=q, max_results=max_results):
+        ids.extend(page)
+    return ids
+
+
+# Concurrent batch requests; bounded to stay clear of Gmail's per-user rate limits
+MAX_FETCH_WORKERS = 8
+
+# One long-lived pool shared by all requests: its threads keep stable idents,
+# so per-thread services cached by gmail_helpers.get_service are reused across
+# requests instead of being rebuilt (and orphaned) by a new pool every call
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_executor_lock = threading.Lock()
+
+
+def _fetch_executor() -> ThreadPoolExecutor:
+    global _executor, _executor_pid
+    # Created on first use, and again in a forked child (threads don't survive fork())
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS, thread_name_prefix="gmail-fetch")
+                _executor_pid = os.getpid()
+    return _executor  # type: ignore[return-value]
+
+
+def fetch_messages_plain(
+    service_factory: Callable[[], Any],
+    id_pages: Iterable[List[str]],
+    user_id: str = "me",
+    max_body_chars: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Fetch normalized messages for pages of IDs on the shared fetch pool.
+
+    Each page is submitted as a ``get_messages_plain_batch`` task as soon as it
+    is produced, so listing further pages overlaps with body fetches.
+    ``service_factory`` returns a Gmail service for the calling worker thread
+    (the underlying httplib2 transport is not thread-safe); it is called once
+    per thread per call, so it should cache per thread.
+    Results keep the order of the IDs.
+    """
+    local = threading.local()
+
+    def _fetch(ids: List[str]) -> List[Dict[str, Any]]:
+        if getattr(local, "service", None) is None:
+            local.service = service_factory()
+        return get_messages_plain_batch(local.service, ids, user_id=user_id, max_body_chars=max_body_chars)
+
+    executor = _fetch_executor()
+    futures = [
+        executor.submit(_fetch, page[start:start + BATCH_LIMIT])
+        for page in id_pages
+        for start in range(0, len(page), BATCH_LIMIT)
+    ]
+    results: List[Dict[str, Any]] = []
+    for future in futures:
+        try:
+            results.extend(future.result())
+        except Exception:
+            logger.exception("Failed to fetch a batch of messages")
+    return results
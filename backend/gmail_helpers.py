@@ -3,7 +3,7 @@ Gmail helper utilities for fetching and parsing emails.
 
 Functions:
 - get_service(session_tokens): Build a Gmail API service from stored OAuth2 tokens
-- list_message_ids(service, user_id='me', q=None, max_results=100)
+- list_message_ids(service, user_id='me', q=None, max_results=100): from gmail_client, pages with nextPageToken
 - get_message(service, message_id): Return {id, threadId, date, sender, subject, body}
 - fetch_and_parse_new_emails(session_tokens, processed_store, model_predict_fn, q='newer_than:30d', max_results=50)
 
@@ -17,15 +17,32 @@ For production, persist sessions/tokens and processed message IDs in a DB/Redis.
 from __future__ import annotations
 
 import base64
+import functools
 import os
 import re
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timezone
 import logging
-from typing import Any, Dict, List, Optional, Iterable
+from typing import Any, Dict, List, Optional, Iterable, Tuple
 try:
-    from .gmail_client import extract_plaintext_from_message as _extract_plaintext_from_message
-except Exception:
-    _extract_plaintext_from_message = None  # type: ignore
+    from .gmail_client import (  # type: ignore
+        MESSAGE_FIELDS,
+        NUM_RETRIES,
+        extract_plaintext_from_message as _extract_plaintext_from_message,
+        fetch_messages_plain,
+        iter_message_ids,
+        list_message_ids,  # re-exported; pages with nextPageToken
+    )
+except ImportError:  # imported as a top-level module (uvicorn main:app from backend/)
+    from gmail_client import (  # type: ignore
+        MESSAGE_FIELDS,
+        NUM_RETRIES,
+        extract_plaintext_from_message as _extract_plaintext_from_message,
+        fetch_messages_plain,
+        iter_message_ids,
+        list_message_ids,  # re-exported; pages with nextPageToken
+    )
 
 from dotenv import load_dotenv
 
@@ -39,14 +56,18 @@ try:
 except Exception:
     Credentials = None  # type: ignore
 
+try:
+    import httplib2  # type: ignore
+    from google_auth_httplib2 import AuthorizedHttp  # type: ignore
+except Exception:
+    httplib2 = None  # type: ignore
+    AuthorizedHttp = None  # type: ignore
+
 load_dotenv()
 
+# No-op when the app has already configured the root logger
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
 logger = logging.getLogger(__name__)
-if not logger.handlers:
-    _h = logging.StreamHandler()
-    _h.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [gmail_helpers] %(message)s"))
-    logger.addHandler(_h)
-logger.setLevel(logging.INFO)
 
 
 def _ensure_google_available() -> None:
@@ -55,91 +76,138 @@ def _ensure_google_available() -> None:
 
 
 def _b64url_decode(data: str) -> bytes:
-    # Gmail uses URL-safe base64 without padding; fix padding and decode
-    data += '=' * (-len(data) % 4)
-    return base64.urlsafe_b64decode(data.encode('utf-8'))
+    # Gmail uses URL-safe base64 without padding; urlsafe_b64decode takes the
+    # ASCII str directly, so only the padding is appended (no encode copy)
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) & 3))
+
+
+_BR_RE = re.compile(r"<\s*br\s*/?>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
 
 
 def _strip_html(html: str) -> str:
     # Very simple tag stripper for fallback cases
-    text = re.sub(r"<\s*br\s*/?>", "\n", html, flags=re.IGNORECASE)
-    text = re.sub(r"<[^>]+>", " ", text)
-    return re.sub(r"\s+", " ", text).strip()
+    return _WS_RE.sub(" ", _TAG_RE.sub(" ", _BR_RE.sub("\n", html))).strip()
 
 
-def _extract_plain_text(payload: Dict[str, Any]) -> str:
+def _extract_plain_text(payload: Dict[str, Any], max_body_chars: Optional[int] = None) -> str:
     """Best-effort extraction of a plaintext body from a Gmail message payload.
 
     Prefers text/plain; falls back to text/html with basic tag stripping.
-    Recurses into multipart parts.
+    Walks multipart parts iteratively (document order) and joins once at the end.
+    With ``max_body_chars``, stops decoding text/plain parts once that many
+    characters are collected and clips the result.
     """
     if not payload:
         return ""
 
-    mime_type = payload.get("mimeType", "")
-    body = payload.get("body", {}) or {}
-    data = body.get("data")
-
-    # If direct text/plain part
-    if mime_type.startswith("text/plain") and data:
-        try:
-            return _b64url_decode(data).decode("utf-8", errors="ignore").strip()
-        except Exception:
-            return ""
-
-    # Multipart: search parts
-    parts: Iterable[Dict[str, Any]] = payload.get("parts", []) or []
-    collected_text = ""
-    html_fallback = ""
-    for p in parts:
-        t = _extract_plain_text(p)
-        if t:
-            collected_text += ("\n" if collected_text else "") + t
-        else:
-            # consider html fallback on this level
-            mt = p.get("mimeType", "")
-            bd = (p.get("body", {}) or {}).get("data")
-            if mt.startswith("text/html") and bd:
-                try:
-                    html_fallback += ("\n" if html_fallback else "") + _b64url_decode(bd).decode("utf-8", errors="ignore")
-                except Exception:
-                    pass
-
-    if collected_text:
-        return collected_text.strip()
-
-    # Fallback: text/html directly on payload
-    if mime_type.startswith("text/html") and data:
-        try:
-            html = _b64url_decode(data).decode("utf-8", errors="ignore")
-            return _strip_html(html)
-        except Exception:
-            return ""
-
-    if html_fallback:
-        return _strip_html(html_fallback)
-
-    # Last resort: if a non-empty data exists, decode anyway
+    plain_parts: List[str] = []
+    plain_len = 0
+    html_parts: List[str] = []
+    stack: List[Dict[str, Any]] = [payload]
+    while stack:
+        part = stack.pop()
+        mime_type = part.get("mimeType", "") or ""
+        data = (part.get("body", {}) or {}).get("data")
+        # HTML is only needed while no text/plain content has been found
+        if data and (mime_type.startswith("text/plain") or (mime_type.startswith("text/html") and not plain_parts)):
+            try:
+                text = _b64url_decode(data).decode("utf-8", errors="ignore")
+            except Exception:
+                text = ""
+            if mime_type.startswith("text/plain"):
+                text = text.strip()
+                if text:
+                    plain_parts.append(text)
+                    plain_len += len(text) + 1
+                    if max_body_chars is not None and plain_len >= max_body_chars:
+                        break
+            elif text:
+                html_parts.append(text)
+        children: Iterable[Dict[str, Any]] = part.get("parts", []) or []
+        stack.extend(reversed(list(children)))
+
+    if plain_parts:
+        # Parts are already stripped individually
+        return "\n".join(plain_parts)[:max_body_chars]
+
+    if html_parts:
+        return _strip_html("\n".join(html_parts))[:max_body_chars]
+
+    # Last resort: if a non-empty data exists on the payload, decode anyway
+    data = (payload.get("body", {}) or {}).get("data")
     if data:
         try:
-            return _b64url_decode(data).decode("utf-8", errors="ignore").strip()
+            return _b64url_decode(data).decode("utf-8", errors="ignore").strip()[:max_body_chars]
         except Exception:
             return ""
 
     return ""
 
 
+# Built services keyed by (access_token, refresh_token, thread id). Discovery
+# parsing and client construction cost tens of ms, so reuse them; the thread id is
+# part of the key because the httplib2 transport is not thread-safe. Callers run
+# on long-lived threads (the server's threadpool and gmail_client's shared fetch
+# pool), so the same few entries per token are hit again on later requests.
+SERVICE_TTL_SECONDS = 30 * 60
+_SERVICE_CACHE_MAX = 256
+_SERVICE_CACHE: Dict[Tuple[str, str, int], Tuple[float, Any]] = {}
+_SERVICE_CACHE_LOCK = threading.Lock()
+# Same default as googleapiclient.http.build_http
+HTTP_TIMEOUT_SECONDS = 60
+
+
 def get_service(session_tokens: Dict[str, Any]) -> Any:
     """Return a Gmail API service from stored OAuth2 tokens.
 
+    Services are cached per token and thread for ``SERVICE_TTL_SECONDS``.
     session_tokens expected keys: access_token, refresh_token, scopes, expiry (optional)
     Requires GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET env vars for refresh.
     """
-    _ensure_google_available()
+    key = (
+        session_tokens.get("access_token") or "",
+        session_tokens.get("refresh_token") or "",
+        threading.get_ident(),
+    )
+    now = time.monotonic()
+    with _SERVICE_CACHE_LOCK:
+        cached = _SERVICE_CACHE.get(key)
+        if cached is not None and now - cached[0] < SERVICE_TTL_SECONDS:
+            return cached[1]
+
+    service = _build_service(session_tokens)
+
+    with _SERVICE_CACHE_LOCK:
+        for k in [k for k, (built_at, _) in _SERVICE_CACHE.items() if now - built_at >= SERVICE_TTL_SECONDS]:
+            del _SERVICE_CACHE[k]
+        if len(_SERVICE_CACHE) >= _SERVICE_CACHE_MAX:
+            del _SERVICE_CACHE[min(_SERVICE_CACHE, key=lambda k: _SERVICE_CACHE[k][0])]
+        _SERVICE_CACHE[key] = (now, service)
+    return service
+
+
+@functools.lru_cache(maxsize=_SERVICE_CACHE_MAX)
+def _credentials_for(token: Optional[str], refresh_token: Optional[str], scopes: Tuple[str, ...]) -> Any:
+    """Return one shared Credentials object per token pair.
 
-    client_id = os.getenv("GOOGLE_CLIENT_ID")
-    client_secret = os.getenv("GOOGLE_CLIENT_SECRET")
-    token_uri = "https://oauth2.googleapis.com/token"
+    Services built for different worker threads reuse it, so a refresh done by
+    one thread is seen by the others instead of each refreshing on its own.
+    """
+    return Credentials(
+        token=token,
+        refresh_token=refresh_token,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=os.getenv("GOOGLE_CLIENT_ID"),
+        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+        scopes=list(scopes),
+    )
+
+
+def _build_service(session_tokens: Dict[str, Any]) -> Any:
+    """Build a new Gmail API service from stored OAuth2 tokens (uncached)."""
+    _ensure_google_available()
 
     token = session_tokens.get("access_token")
     refresh_token = session_tokens.get("refresh_token")
@@ -147,58 +215,68 @@ def get_service(session_tokens: Dict[str, Any]) -> Any:
         "openid", "email", "profile", "https://www.googleapis.com/auth/gmail.readonly"
     ]
 
-    creds = Credentials(
-        token=token,
-        refresh_token=refresh_token,
-        token_uri=token_uri,
-        client_id=client_id,
-        client_secret=client_secret,
-        scopes=scopes,
-    )
+    if isinstance(scopes, str):
+        scopes = scopes.split()
+    creds = _credentials_for(token, refresh_token, tuple(scopes))
+
+    if AuthorizedHttp is not None and httplib2 is not None:
+        # One keep-alive connection pool per service; since services are cached
+        # per thread, the TLS connection to gmail.googleapis.com is reused
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS))
+        return build("gmail", "v1", http=http, cache_discovery=False)
 
     service = build("gmail", "v1", credentials=creds, cache_discovery=False)
     return service
 
 
-def list_message_ids(service: Any, user_id: str = "me", q: Optional[str] = None, max_results: int = 100) -> List[str]:
-    """List message IDs for a user, optionally filtered by Gmail search query q.
+def _parse_message(msg: Dict[str, Any], max_body_chars: Optional[int] = None) -> Dict[str, Any]:
+    """Extract key fields from a full Gmail message JSON into a simple dict.
 
-    Ignores pagination for simplicity; for larger fetches, add nextPageToken handling.
+    ``max_body_chars`` caps the body (``None`` keeps all of it).
     """
-    req = service.users().messages().list(userId=user_id, q=q, maxResults=max_results)
-    resp = req.execute() or {}
-    messages = resp.get("messages", []) or []
-    return [m.get("id") for m in messages if m.get("id")]
-
-
-def get_message(service: Any, message_id: str, user_id: str = "me") -> Dict[str, Any]:
-    """Fetch a full Gmail message and extract key fields into a simple dict."""
-    msg = service.users().messages().get(userId=user_id, id=message_id, format="full").execute() or {}
+    msg = msg or {}
     payload = msg.get("payload", {}) or {}
     headers = payload.get("headers", []) or []
 
-    header_map = {h.get("name", "").lower(): h.get("value", "") for h in headers}
-    sender = header_map.get("from", "")
-    subject = header_map.get("subject", "")
-    date_header = header_map.get("date")
+    # Single pass that stops once From/Subject/Date are all captured; only
+    # names starting with f/s/d get lowercased
+    sender: Optional[str] = None
+    subject: Optional[str] = None
+    date_header: Optional[str] = None
+    needed = 3
+    for h in headers:
+        name = h.get("name") or ""
+        if not name or name[0] not in "FSDfsd":
+            continue
+        lname = name.lower()
+        if lname == "from" and sender is None:
+            sender = h.get("value", "")
+            needed -= 1
+        elif lname == "subject" and subject is None:
+            subject = h.get("value", "")
+            needed -= 1
+        elif lname == "date" and date_header is None:
+            date_header = h.get("value", "")
+            needed -= 1
+        if needed == 0:
+            break
+    sender = sender or ""
+    subject = subject or ""
 
     # internalDate is ms since epoch
     internal_ms = msg.get("internalDate")
     date_iso = None
     try:
         if internal_ms:
-            date_iso = datetime.utcfromtimestamp(int(internal_ms) / 1000).date().isoformat()
+            date_iso = datetime.fromtimestamp(int(internal_ms) // 1000, timezone.utc).date().isoformat()
     except Exception:
         date_iso = None
 
-    # Prefer robust extractor from gmail_client if available; fallback to local implementation
-    if _extract_plaintext_from_message is not None:
-        try:
-            body_text = _extract_plaintext_from_message(msg)
-        except Exception:
-            body_text = _extract_plain_text(payload)
-    else:
-        body_text = _extract_plain_text(payload)
+    # Prefer robust extractor from gmail_client; fallback to local implementation
+    try:
+        body_text = _extract_plaintext_from_message(msg, max_body_chars)
+    except Exception:
+        body_text = _extract_plain_text(payload, max_body_chars)
 
     return {
         "id": msg.get("id"),
@@ -211,12 +289,33 @@ def get_message(service: Any, message_id: str, user_id: str = "me") -> Dict[str,
     }
 
 
+def get_message(
+    service: Any,
+    message_id: str,
+    user_id: str = "me",
+    fields: Optional[str] = None,
+    max_body_chars: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Fetch a full Gmail message and extract key fields into a simple dict.
+
+    ``fields`` is an optional partial-response mask, e.g. ``MESSAGE_FIELDS``;
+    ``max_body_chars`` caps the body.
+    """
+    msg = (
+        service.users().messages().get(userId=user_id, id=message_id, format="full", fields=fields)
+        .execute(num_retries=NUM_RETRIES)
+        or {}
+    )
+    return _parse_message(msg, max_body_chars)
+
+
 def fetch_and_parse_new_emails(
     session_tokens: Dict[str, Any],
     processed_store: Any,
     model_predict_fn,
     q: Optional[str] = "newer_than:30d",
     max_results: int = 50,
+    max_body_chars: Optional[int] = None,
 ) -> List[Dict[str, Any]]:
     """Fetch recent Gmail messages, parse them, classify via model_predict_fn, and return processed items.
 
@@ -224,11 +323,11 @@ def fetch_and_parse_new_emails(
     - processed_store: set/dict-like to track processed message IDs
     - model_predict_fn(subject, body) -> list[str]: returns two categories
     - q: Gmail search string, defaults to last 30 days
+    - max_body_chars: cap on each decoded body (None keeps full bodies)
 
     Returns a list of dicts: {id, threadId, date, sender, subject, body, categories, processed_at}
     """
     service = get_service(session_tokens)
-    ids = list_message_ids(service, user_id="me", q=q, max_results=max_results)
     processed: List[Dict[str, Any]] = []
 
     def _already_processed(mid: str) -> bool:
@@ -243,11 +342,29 @@ def fetch_and_parse_new_emails(
         except Exception:
             processed_store[mid] = True  # type: ignore[index]
 
-    for mid in ids:
-        if not mid or _already_processed(mid):
-            continue
-
-        info = get_message(service, mid)
+    now_iso = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+    filter_new = getattr(processed_store, "filter_new", None)
+    if filter_new is None:
+        def filter_new(page: List[str]) -> List[str]:
+            return [mid for mid in page if mid and not _already_processed(mid)]
+
+    def new_id_pages() -> Iterable[List[str]]:
+        # Page through the listing and stop as soon as max_results unprocessed
+        # messages are found (scanning a bounded window of recent mail)
+        found = 0
+        search_limit = min(500, max(50, max_results * 10))
+        for page in iter_message_ids(service, user_id="me", q=q, max_results=search_limit):
+            new = filter_new(page)[:max_results - found]
+            if new:
+                found += len(new)
+                yield new
+            if found >= max_results:
+                break
+
+    # Batched requests on a thread pool (overlapping the listing), then classify
+    for info in fetch_messages_plain(lambda: get_service(session_tokens), new_id_pages(), max_body_chars=max_body_chars):
+        mid = info.get("id")
         subject = info.get("subject") or ""
         body = info.get("body") or ""
 
@@ -264,11 +381,11 @@ def fetch_and_parse_new_emails(
             "id": info.get("id"),
             "threadId": info.get("threadId"),
             "date": info.get("date"),
-            "sender": info.get("sender"),
+            "sender": info.get("from"),
             "subject": subject,
             "body": body,
             "categories": cats,
-            "processed_at": datetime.utcnow().isoformat() + "Z",
+            "processed_at": now_iso,
         }
         processed.append(item)
         _mark_processed(mid)
@@ -285,5 +402,5 @@ def fetch_and_parse_new_emails(
 #         return res.get("top_2_categories") or res.get("top_categories", [])
 #     return ["General", "Information"]
 #
-# SESSIONS is an in-memory dict from your app storing tokens per session_id
-# items = fetch_and_parse_new_emails(SESSIONS[session_id], set(), predict_top2)
\ No newline at end of file
+# SESSION_STORE is the app's SessionStore holding tokens per session_id
+# items = fetch_and_parse_new_emails(SESSION_STORE.get(session_id), set(), predict_top2)
\ No newline at end of file
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 try:
     import joblib  # type: ignore
@@ -60,7 +60,12 @@ def predict_top2(subject: str, body: str) -> List[str]:
             if isinstance(proba, (list, tuple)):
                 proba = proba[0]
             arr = np.array(proba).reshape(-1)
-            top2 = arr.argsort()[-2:][::-1]
+            if arr.size >= 2:
+                # O(C) partial selection, then order the two winners
+                idx = np.argpartition(arr, -2)[-2:]
+                top2 = idx[np.argsort(arr[idx])[::-1]]
+            else:
+                top2 = arr.argsort()[::-1]
             classes = getattr(_model, "classes_", None)
             if classes is not None:
                 return [str(classes[i]) for i in top2]
@@ -71,7 +76,41 @@ def predict_top2(subject: str, body: str) -> List[str]:
         return fallback
 
 
+def predict_top2_batch(pairs: List[Tuple[str, str]]) -> List[List[str]]:
+    """Return two category strings for each (subject, body) pair.
+
+    Runs one vectorized ``predict_proba`` over the whole batch and picks the
+    top two classes per row with ``np.argpartition``. Falls back to
+    ``predict_top2`` per pair if the model has no probabilities, and to
+    ["General", "Information"] per pair if the model isn't loaded or fails.
+    """
+    fallback = ["General", "Information"]
+    if not pairs:
+        return []
+    if _model is None:
+        return [list(fallback) for _ in pairs]
+    if not hasattr(_model, "predict_proba"):
+        return [predict_top2(subject, body) for subject, body in pairs]
+
+    try:
+        import numpy as np  # lazy import
+        texts = [f"{subject} {body}".strip() for subject, body in pairs]
+        proba = np.asarray(_model.predict_proba(texts))  # type: ignore[attr-defined]
+        classes = getattr(_model, "classes_", None)
+        if classes is None or proba.ndim != 2 or proba.shape[1] < 2:
+            return [list(fallback) for _ in pairs]
+        # Unordered top-2 per row in O(C), then order each pair by probability
+        top2 = np.argpartition(-proba, 1, axis=1)[:, :2]
+        rows = np.arange(len(texts))[:, None]
+        order = np.argsort(-proba[rows, top2], axis=1)
+        top2 = np.take_along_axis(top2, order, axis=1)
+        return [[str(classes[i]), str(classes[j])] for i, j in top2]
+    except Exception:
+        return [list(fallback) for _ in pairs]
+
+
 # Usage:
 #   from backend.joblib_model import load_model, predict_top2
 #   load_model()  # optionally pass custom path
 #   labels = predict_top2("Subject", "Body text")
+#   batch_labels = predict_top2_batch([("Subject", "Body text"), ...])
@@ -3,49 +3,125 @@ from __future__ import annotations
 import os
 import sys
 import logging
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Annotated
+from typing import Any, Dict, List, Optional, Set, Annotated
 
 from fastapi import HTTPException, Request, Header
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 
 # Import the core app and shared state from simple_main
-from simple_main import app, SESSIONS  # type: ignore
+from simple_main import app, SESSION_STORE  # type: ignore
 import simple_main  # Import module to access classifier dynamically
 
 # Gmail helpers and processed store
-from gmail_helpers import fetch_and_parse_new_emails  # type: ignore
+from gmail_helpers import fetch_and_parse_new_emails, get_service  # type: ignore
 from processed_store import ProcessedStore  # type: ignore
 from processed_emails_store import ProcessedEmailsStore  # type: ignore
-from gmail_client import get_message_plain, list_message_ids  # type: ignore
+from gmail_client import fetch_messages_plain, get_message_plain, iter_message_ids  # type: ignore
 
 
 # -------------- Logging configuration --------------
-root_logger = logging.getLogger()
-if not root_logger.handlers:
-    h = logging.StreamHandler(sys.stdout)
-    h.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
-    root_logger.addHandler(h)
-root_logger.setLevel(logging.INFO)
+# force=True replaces the stderr default the imported gmail modules may have installed
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+    stream=sys.stdout,
+    force=True,
+)
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 
 # Simple in-memory cache of processed items for GET /emails (dev-only)
 PROCESSED_ITEMS: List[Dict[str, Any]] = []
+# IDs present in PROCESSED_ITEMS, maintained incrementally for O(1) dedup
+PROCESSED_ITEMS_INDEX: Set[str] = set()
 
 # JSON store of processed message IDs to avoid reprocessing
 DATA_DIR = Path(__file__).resolve().parent
 STORE_PATH_ENV = os.getenv("PROCESSED_STORE_PATH")
-STORE_PATH = Path(STORE_PATH_ENV) if STORE_PATH_ENV else (DATA_DIR / "processed_ids.json")
-STORE = ProcessedStore(STORE_PATH)
+STORE_PATH = Path(STORE_PATH_ENV) if STORE_PATH_ENV else (DATA_DIR / "processed_ids.jsonl")
 
 EMAILS_STORE_PATH_ENV = os.getenv("PROCESSED_EMAILS_STORE_PATH")
-EMAILS_STORE_PATH = Path(EMAILS_STORE_PATH_ENV) if EMAILS_STORE_PATH_ENV else (DATA_DIR / "processed_emails.json")
-EMAILS_STORE = ProcessedEmailsStore(EMAILS_STORE_PATH)
+EMAILS_STORE_PATH = Path(EMAILS_STORE_PATH_ENV) if EMAILS_STORE_PATH_ENV else (DATA_DIR / "processed_emails.jsonl")
+
+# "json" (default) keeps the JSONL files above; "sqlite" keeps both stores in
+# one WAL-mode database at PROCESSED_DB_PATH
+STORE_BACKEND = os.getenv("STORE_BACKEND", "json").strip().lower()
+DB_PATH_ENV = os.getenv("PROCESSED_DB_PATH")
+DB_PATH = Path(DB_PATH_ENV) if DB_PATH_ENV else (DATA_DIR / "processed.db")
+
+if STORE_BACKEND == "sqlite":
+    from processed_store import backup  # type: ignore
+    from sqlite_store import SQLiteProcessedStore, SQLiteProcessedEmailsStore  # type: ignore
+
+    _new_db = not DB_PATH.exists()
+    STORE = SQLiteProcessedStore(DB_PATH)
+    EMAILS_STORE = SQLiteProcessedEmailsStore(DB_PATH)
+    if _new_db:
+        # One-time import of the existing JSON stores into the fresh database
+        backup(STORE_PATH, DB_PATH)
+        _json_emails = ProcessedEmailsStore(EMAILS_STORE_PATH)
+        EMAILS_STORE.overwrite_all(_json_emails.get_all())
+        _json_emails.close()
+else:
+    STORE = ProcessedStore(STORE_PATH)
+    EMAILS_STORE = ProcessedEmailsStore(EMAILS_STORE_PATH)
+
+# Bodies are decoded only up to MAX_BODY_CHARS characters when listing/fetching
+# (this is what gets stored and shown in the detail view; 0 keeps full bodies).
+# Categories are derived from the subject plus the first CLASSIFY_BODY_CHARS
+# characters, about what the classifier's 512-token window holds anyway.
+MAX_BODY_CHARS: Optional[int] = int(os.getenv("MAX_BODY_CHARS", "20000")) or None
+CLASSIFY_BODY_CHARS = int(os.getenv("CLASSIFY_BODY_CHARS", "2000"))
+
+if STORE_BACKEND == "sqlite":
+    logger.info("Processed stores (sqlite): %s", DB_PATH)
+else:
+    logger.info("Processed IDs store: %s", STORE_PATH)
+    logger.info("Processed emails store: %s", EMAILS_STORE_PATH)
+
+
+class _StoreAdapter(set):
+    """Set-like processed-ID view handed to fetch_and_parse_new_emails.
+
+    Membership checks go to STORE (plus the IDs added during this run); adds are
+    written to STORE in one batch by ``flush``.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        # dict keeps insertion order for the batched write with O(1) lookups
+        self._pending: Dict[str, None] = {}
+
+    def __contains__(self, x):
+        return x in self._pending or STORE.has(x)
+
+    def filter_new(self, ids):
+        return [x for x in STORE.filter_new(ids) if x not in self._pending]
+
+    def add(self, x):
+        self._pending[x] = None
+
+    def flush(self) -> None:
+        if self._pending:
+            STORE.add_many(list(self._pending))
+            self._pending.clear()
+
 
-logger.info("Processed IDs store: %s", STORE_PATH)
-logger.info("Processed emails store: %s", EMAILS_STORE_PATH)
+def _utc_now_iso() -> str:
+    """Current UTC time as ISO-8601 with a trailing Z (computed once per handler)."""
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _remember_items(items: List[Dict[str, Any]]) -> None:
+    """Append items to PROCESSED_ITEMS, skipping IDs it already holds."""
+    for it in items:
+        iid = it.get("id")
+        if iid and iid not in PROCESSED_ITEMS_INDEX:
+            PROCESSED_ITEMS.append(it)
+            PROCESSED_ITEMS_INDEX.add(iid)
 
 
 def model_predict_fn(subject: str, body: str) -> List[str]:
@@ -56,7 +132,7 @@ def model_predict_fn(subject: str, body: str) -> List[str]:
     if simple_main.classifier is None:
         logger.error("Classifier is None; cannot predict")
         raise RuntimeError("Model not loaded")
-    res = simple_main.classifier.predict(subject, body, top_k=2)
+    res = simple_main.classifier.predict(subject, body[:CLASSIFY_BODY_CHARS], top_k=2)
     if not res.get("success"):
         raise RuntimeError(f"Model returned unsuccessful result: {res.get('error')}")
     top2 = res.get("top_2_categories") or res.get("top_categories", [])
@@ -76,29 +152,24 @@ async def fetch_emails(request: Request) -> JSONResponse:
     if not session_id:
         logger.warning("/fetch-emails: missing session_id cookie")
         raise HTTPException(status_code=401, detail="Not logged in")
-    tokens = SESSIONS.get(session_id)
+    tokens = SESSION_STORE.get(session_id)
     if not tokens:
         logger.warning("/fetch-emails: session not found or expired for session_id=%s", session_id)
         raise HTTPException(status_code=401, detail="Session expired or invalid")
 
-    class _StoreAdapter(set):
-        def __contains__(self, x):
-            return STORE.has(x)  # type: ignore[arg-type]
-
-        def add(self, x):
-            STORE.add(x)
-
     store_adapter = _StoreAdapter()
 
-    items = fetch_and_parse_new_emails(tokens, store_adapter, model_predict_fn)
+    # Gmail calls, model inference and store writes block; keep them off the event loop
+    try:
+        items = await run_in_threadpool(
+            fetch_and_parse_new_emails, tokens, store_adapter, model_predict_fn, max_body_chars=MAX_BODY_CHARS
+        )
+    finally:
+        await run_in_threadpool(store_adapter.flush)
 
     if items:
-        seen = {it.get("id") for it in PROCESSED_ITEMS}
-        for it in items:
-            if it.get("id") not in seen:
-                PROCESSED_ITEMS.append(it)
-                seen.add(it.get("id"))
-        EMAILS_STORE.upsert_many(items)
+        _remember_items(items)
+        await run_in_threadpool(EMAILS_STORE.upsert_many, items)
 
     return JSONResponse(items)
 
@@ -109,7 +180,7 @@ async def get_emails(authorization: Annotated[str | None, Header()] = None) -> L
 
     - Requires Authorization: Bearer <access_token>
     - Uses ProcessedStore to avoid reprocessing IDs
-    - Persists results to processed_emails.json
+    - Persists results to processed_emails.jsonl
     """
     if not authorization or not authorization.startswith("Bearer "):
         logger.warning("/emails: missing or invalid Authorization header")
@@ -129,36 +200,29 @@ async def get_emails(authorization: Annotated[str | None, Header()] = None) -> L
         ],
     }
 
-    class _StoreAdapter(set):
-        def __contains__(self, x):
-            return STORE.has(x)  # type: ignore[arg-type]
-
-        def add(self, x):
-            STORE.add(x)
-
     store_adapter = _StoreAdapter()
 
     try:
-        new_items = fetch_and_parse_new_emails(
+        new_items = await run_in_threadpool(
+            fetch_and_parse_new_emails,
             session_tokens,
             store_adapter,
             model_predict_fn,
             q=None,
             max_results=30,
+            max_body_chars=MAX_BODY_CHARS,
         )
         if new_items:
-            seen = {it.get("id") for it in PROCESSED_ITEMS}
-            for it in new_items:
-                if it.get("id") not in seen:
-                    PROCESSED_ITEMS.append(it)
-                    seen.add(it.get("id"))
-            EMAILS_STORE.upsert_many(new_items)
+            _remember_items(new_items)
+            await run_in_threadpool(EMAILS_STORE.upsert_many, new_items)
     except Exception as e:
         logger.exception("/emails: failed to fetch emails: %s", e)
         raise HTTPException(status_code=401, detail=f"Failed to fetch emails: {e}")
+    finally:
+        await run_in_threadpool(store_adapter.flush)
 
     try:
-        return EMAILS_STORE.get_all()
+        return await run_in_threadpool(EMAILS_STORE.get_all)
     except Exception:
         return PROCESSED_ITEMS
 
@@ -168,11 +232,13 @@ async def fetch_and_classify(
     authorization: Annotated[str | None, Header()] = None,
     max_results: int = 30,
     q: str | None = None,
+    include_body: bool = True,
 ) -> Dict[str, Any]:
     """Fetch recent Gmail messages and classify only the new ones.
 
     - Requires Authorization: Bearer <access_token>
     - Uses ProcessedStore to avoid reprocessing
+    - include_body=false leaves bodies out of the response (they are still stored)
     - Returns: {"new_count": n, "processed": [...]} 
     """
     if not authorization or not authorization.startswith("Bearer "):
@@ -183,49 +249,51 @@ async def fetch_and_classify(
         logger.warning("/fetch-and-classify: empty token in Authorization header")
         raise HTTPException(status_code=401, detail="Missing token")
 
-    # Build Gmail service from bare token
+    # Build (or reuse) a Gmail service from the bare token; services are cached
+    # per token and thread, so worker threads call get_service themselves
+    session_tokens = {"access_token": token}
     try:
-        from google.oauth2.credentials import Credentials  # type: ignore
-        from googleapiclient.discovery import build  # type: ignore
-
-        creds = Credentials(token=token)
-        service = build("gmail", "v1", credentials=creds, cache_discovery=False)
+        await run_in_threadpool(get_service, session_tokens)
     except Exception as e:
         logger.exception("/fetch-and-classify: failed to build Gmail service: %s", e)
         raise HTTPException(status_code=401, detail=f"Failed to build Gmail service: {e}")
 
     # List message ids (search across more than batch size to account for already-processed items)
-    try:
-        # Search a wider window so we can find enough unprocessed messages for this batch
-        search_limit = min(500, max(50, int(max_results) * 10))
-        ids = list_message_ids(service, user_id="me", q=q, max_results=search_limit)
-    except Exception as e:
-        logger.exception("/fetch-and-classify: failed to list messages: %s", e)
-        raise HTTPException(status_code=401, detail=f"Failed to list messages: {e}")
-
-    # Filter out already processed IDs to estimate and iterate
-    ids_new_all = [mid for mid in ids if mid and not STORE.has(mid)]
-    # Only classify up to requested batch size in this call
-    ids_new = ids_new_all[:max_results]
+    # Search a wider window so we can find enough unprocessed messages for this batch
+    search_limit = min(500, max(50, int(max_results) * 10))
+    scanned = 0
+    ids_new: List[str] = []
+
+    def new_id_pages():
+        # Filter each listed page against the store and hand it straight to the
+        # fetch pool; stop listing once enough unprocessed messages are found
+        nonlocal scanned
+        for page in iter_message_ids(get_service(session_tokens), user_id="me", q=q, max_results=search_limit):
+            scanned += len(page)
+            new = STORE.filter_new(page)[:max_results - len(ids_new)]
+            if new:
+                ids_new.extend(new)
+                yield new
+            if len(ids_new) >= max_results:
+                break
+
+    # Fetch bodies (batched HTTP requests on a thread pool, overlapping the listing);
+    # the whole pipeline blocks, so run it off the event loop
+    messages_data = await run_in_threadpool(
+        fetch_messages_plain,
+        lambda: get_service(session_tokens),
+        new_id_pages(),
+        user_id="me",
+        max_body_chars=MAX_BODY_CHARS,
+    )
     est_ms = len(ids_new) * 500  # optimized: ~500ms per message with batch processing
     logger.info(
-        "/fetch-and-classify: scanned=%d, new_found=%d, batching=%d, est ~%d ms",
-        len(ids), len(ids_new_all), len(ids_new), est_ms,
+        "/fetch-and-classify: scanned=%d, new=%d, fetched=%d, est ~%d ms",
+        scanned, len(ids_new), len(messages_data), est_ms,
     )
 
     new_results: List[Dict[str, Any]] = []
-    
-    # Batch processing: fetch all messages first, then classify in batch
-    messages_data: List[Dict[str, Any]] = []
-    for mid in ids_new:
-        if not mid:
-            continue
-        try:
-            info = get_message_plain(service, mid)
-            messages_data.append(info)
-        except Exception as e:
-            logger.warning("Failed to fetch message %s: %s", mid, e)
-            continue
+    now_iso = _utc_now_iso()
     
     if not messages_data:
         return {"new_count": 0, "processed": [], "estimated_ms": 0}
@@ -234,13 +302,18 @@ async def fetch_and_classify(
     # Use smaller sub-batches to reduce memory on Render free tier
     try:
         logger.info("/fetch-and-classify: Batch classifying %d messages...", len(messages_data))
-        emails_for_batch = [{"subject": m.get("subject") or "", "body": m.get("body") or ""} for m in messages_data]
+        emails_for_batch = [
+            {"subject": m.get("subject") or "", "body": (m.get("body") or "")[:CLASSIFY_BODY_CHARS]}
+            for m in messages_data
+        ]
         
         if simple_main.classifier is None:
             raise RuntimeError("Model not loaded")
         
         # Use batch_size=2 for memory-constrained environments (Render free tier)
-        batch_results = simple_main.classifier.predict_batch(emails_for_batch, top_k=2, batch_size=2)
+        batch_results = await run_in_threadpool(
+            simple_main.classifier.predict_batch, emails_for_batch, top_k=2, batch_size=2
+        )
         
         for info, result in zip(messages_data, batch_results):
             if not result.get("success"):
@@ -261,49 +334,25 @@ async def fetch_and_classify(
                 "subject": info.get("subject") or "",
                 "body": info.get("body") or "",
                 "categories": cats,
-                "processed_at": __import__("datetime").datetime.utcnow().isoformat() + "Z",
+                "processed_at": now_iso,
             }
             new_results.append(item)
-            STORE.add(info.get("id"))
             
         logger.info("/fetch-and-classify: Successfully classified %d/%d messages", len(new_results), len(messages_data))
         
     except Exception as e:
+        # predict_batch already halves its sub-batch size down to single emails
+        # on failure, so a per-message retry here would only repeat that work
         logger.exception("Batch classification error: %s", e)
-        # Fallback to single processing if batch fails
-        logger.info("Falling back to single-message classification...")
-        for info in messages_data:
-            try:
-                subject = info.get("subject") or ""
-                body = info.get("body") or ""
-                cats = model_predict_fn(subject, body)
-                if not isinstance(cats, list) or len(cats) != 2:
-                    continue
-                item = {
-                    "id": info.get("id"),
-                    "threadId": info.get("threadId"),
-                    "date": info.get("date"),
-                    "sender": info.get("from"),
-                    "subject": subject,
-                    "body": body,
-                    "categories": cats,
-                    "processed_at": __import__("datetime").datetime.utcnow().isoformat() + "Z",
-                }
-                new_results.append(item)
-                STORE.add(info.get("id"))
-            except Exception as e2:
-                logger.exception("Single classification error for message %s: %s", info.get("id"), e2)
-                continue
 
     if new_results:
-        EMAILS_STORE.upsert_many(new_results)
-        seen = {it.get("id") for it in PROCESSED_ITEMS}
-        for it in new_results:
-            if it.get("id") not in seen:
-                PROCESSED_ITEMS.append(it)
-                seen.add(it.get("id"))
+        new_ids = [it.get("id") for it in new_results]
+        await run_in_threadpool(STORE.add_many, new_ids)
+        await run_in_threadpool(EMAILS_STORE.upsert_many, new_results)
+        _remember_items(new_results)
 
-    return {"new_count": len(new_results), "processed": new_results, "estimated_ms": est_ms}
+    processed = new_results if include_body else [{k: v for k, v in it.items() if k != "body"} for it in new_results]
+    return {"new_count": len(new_results), "processed": processed, "estimated_ms": est_ms}
 
 
 @app.post("/reclassify/{message_id}")
@@ -324,23 +373,24 @@ async def reclassify_message(
         logger.warning("/reclassify: empty token in Authorization header")
         raise HTTPException(status_code=401, detail="Missing token")
 
+    session_tokens = {"access_token": token}
     try:
-        from google.oauth2.credentials import Credentials  # type: ignore
-        from googleapiclient.discovery import build  # type: ignore
-
-        creds = Credentials(token=token)
-        service = build("gmail", "v1", credentials=creds, cache_discovery=False)
+        await run_in_threadpool(get_service, session_tokens)
     except Exception as e:
         logger.exception("/reclassify: failed to build Gmail service: %s", e)
         raise HTTPException(status_code=401, detail=f"Failed to build Gmail service: {e}")
 
     try:
-        info = get_message_plain(service, message_id)
+        info = await run_in_threadpool(
+            # Single message the user is looking at: keep its full body
+            lambda: get_message_plain(get_service(session_tokens), message_id)
+        )
         subject = info.get("subject") or ""
         body = info.get("body") or ""
-        cats = model_predict_fn(subject, body)
+        cats = await run_in_threadpool(model_predict_fn, subject, body)
         if not isinstance(cats, list) or len(cats) != 2:
             raise RuntimeError("Model did not return exactly two labels")
+        now_iso = _utc_now_iso()
         item = {
             "id": info.get("id"),
             "threadId": info.get("threadId"),
@@ -349,14 +399,12 @@ async def reclassify_message(
             "subject": subject,
             "body": body,
             "categories": cats,
-            "processed_at": __import__("datetime").datetime.utcnow().isoformat() + "Z",
+            "processed_at": now_iso,
         }
-        EMAILS_STORE.upsert_many([item])
+        await run_in_threadpool(EMAILS_STORE.upsert_many, [item])
         # update in-memory cache and processed store
-        seen = {it.get("id") for it in PROCESSED_ITEMS}
-        if item.get("id") not in seen:
-            PROCESSED_ITEMS.append(item)
-        STORE.add(message_id)
+        _remember_items([item])
+        await run_in_threadpool(STORE.add, message_id)
         return item
     except HTTPException:
         raise
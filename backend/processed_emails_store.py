@@ -1,96 +1,254 @@
 """
-ProcessedEmailsStore: JSON-backed storage for classified Gmail emails.
-
-Shape on disk (example):
-{
-  "emails": {
-    "18c123": {
-      "id": "18c123",
-      "threadId": "1789ab",
-      "date": "2025-10-16",
-      "sender": "Alice <alice@example.com>",
-      "subject": "Hello",
-      "body": "...",
-      "categories": ["announcements", "deadlines"],
-      "processed_at": "2025-10-17T09:15:10Z"
-    },
-    ...
-  }
-}
+ProcessedEmailsStore: append-only JSON Lines storage for classified Gmail emails.
+
+Shape on disk (one JSON object per line; the last line for an id wins):
+{"id": "18c123", "threadId": "1789ab", "date": "2025-10-16", "sender": "Alice <alice@example.com>", "subject": "Hello", "body": "...", "categories": ["announcements", "deadlines"], "processed_at": "2025-10-17T09:15:10Z"}
+{"id": "18c124", ...}
 
 Notes:
-- Thread-safe with a lock and atomic writes via temp file + os.replace.
-- Upsert semantics keyed by message id.
+- The file is parsed once at startup, line by line from a read-only mmap,
+  into an in-memory dict keyed by message id; reads are served from memory.
+- Upserts only update memory and queue the items; a background thread
+  appends them at most every FLUSH_INTERVAL_MS (env, default 200; 0 writes
+  synchronously), one line per item. The file is compacted with an atomic
+  rewrite (temp file + os.replace) once stale lines outnumber live ones.
+  `flush()` runs at interpreter exit; call `close()` before deleting the file.
+- A path ending in .mpk stores the same records as a stream of MessagePack
+  objects instead (needs the optional ``msgpack`` package): smaller than JSON
+  text and faster to decode. On first start it imports the sibling .jsonl
+  file if there is one.
+- A legacy ``{"emails": {...}}`` JSON file (at the store path itself, or next
+  to it with a .json suffix) is imported and rewritten as JSON Lines on start.
+- Thread-safe: writers hold the lock only for the in-memory update and mark
+  the read-only snapshot of the index stale; the first read after that
+  rebuilds it once, later readers use it without locking, and disk I/O
+  happens outside the lock.
 """
 from __future__ import annotations
 
-import json
+import mmap
 import os
 import threading
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import Dict, Iterable, List, Optional
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional
+
+try:
+    import msgpack  # type: ignore
+except ImportError:  # optional: only needed for .mpk store files
+    msgpack = None  # type: ignore
+
+try:
+    from .store_base import COMPACT_MIN_LINES, WriteBehindStore, append_lines, atomic_write, dumps, loads  # type: ignore
+except ImportError:  # imported as a top-level module (uvicorn main:app from backend/)
+    from store_base import COMPACT_MIN_LINES, WriteBehindStore, append_lines, atomic_write, dumps, loads  # type: ignore
 
 
-class ProcessedEmailsStore:
-    def __init__(self, path: str | os.PathLike[str] = "processed_emails.json") -> None:
+def _iter_lines(mm: mmap.mmap) -> Iterator[bytes]:
+    """Yield the non-blank lines of a mapped file as bytes."""
+    start, size = 0, len(mm)
+    while start < size:
+        end = mm.find(b"\n", start)
+        if end == -1:
+            end = size
+        line = mm[start:end].strip()
+        start = end + 1
+        if line:
+            yield line
+
+
+class ProcessedEmailsStore(WriteBehindStore):
+    def __init__(
+        self,
+        path: str | os.PathLike[str] = "processed_emails.jsonl",
+        *,
+        flush_interval_ms: int | None = None,
+    ) -> None:
         self.path = Path(path).resolve()
         self._lock = threading.Lock()
+        self._by_id: Dict[str, Dict[str, object]] = {}
+        # Read-only copy of _by_id for lock-free readers; None when stale
+        self._snapshot: Optional[Mapping[str, Dict[str, object]]] = None
+        self._pending: List[bytes] = []
+        # id -> hash of the record's encoded bytes as last written, to skip no-op upserts
+        self._hashes: Dict[str, int] = {}
+        self._lines = 0
+        self._binary = self.path.suffix == ".mpk"
+        if self._binary and msgpack is None:
+            raise RuntimeError("msgpack is not installed; it is required for .mpk email stores")
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        if not self.path.exists():
-            self._atomic_write({"emails": {}})
+        if self.path.exists():
+            torn = self._load_msgpack() if self._binary else self._load_jsonl(self.path)
+            if torn:
+                # Rewrite cleanly so later appends don't land on a partial record
+                self._atomic_write(self._by_id.values())
+        else:
+            jsonl = self.path.with_suffix(".jsonl")
+            if self._binary and jsonl.exists():
+                # One-shot migration from the JSON Lines store
+                self._load_jsonl(jsonl)
+            else:
+                self._import_legacy()
+            self._atomic_write(self._by_id.values())
+
+        # Debounced write-behind
+        self._init_write_behind(flush_interval_ms)
 
     # ------------ Public API ------------
     def get_all(self) -> List[Dict[str, object]]:
-        data = self._read_json()
-        emails: Dict[str, Dict[str, object]] = data.get("emails", {}) if isinstance(data, dict) else {}
         # Return as a list, stable order not guaranteed; caller may sort as needed
-        return list(emails.values())
+        return list(self._view().values())
 
     def get(self, message_id: str) -> Optional[Dict[str, object]]:
-        data = self._read_json()
-        emails: Dict[str, Dict[str, object]] = data.get("emails", {}) if isinstance(data, dict) else {}
-        return emails.get(str(message_id))
+        return self._view().get(str(message_id))
 
     def upsert(self, item: Dict[str, object]) -> None:
-        mid = str(item.get("id") or "").strip()
-        if not mid:
-            return
-        with self._lock:
-            data = self._read_json()
-            emails: Dict[str, Dict[str, object]] = data.get("emails", {}) if isinstance(data, dict) else {}
-            emails[mid] = item
-            self._atomic_write({"emails": emails})
+        self.upsert_many([item])
 
     def upsert_many(self, items: Iterable[Dict[str, object]]) -> None:
+        batch: Dict[str, Dict[str, object]] = {}
+        for it in items:
+            mid = str(it.get("id") or "").strip()
+            if mid:
+                batch[mid] = it
+        if not batch:
+            return
+        # Serialize outside the lock; these bytes are what flush() appends
+        encoded = {mid: self._encode(it) for mid, it in batch.items()}
         with self._lock:
-            data = self._read_json()
-            emails: Dict[str, Dict[str, object]] = data.get("emails", {}) if isinstance(data, dict) else {}
-            for it in items:
-                mid = str(it.get("id") or "").strip()
-                if mid:
-                    emails[mid] = it
-            self._atomic_write({"emails": emails})
+            changed = False
+            for mid, data in encoded.items():
+                digest = hash(data)
+                if self._hashes.get(mid) == digest:
+                    # Byte-identical to the stored record (e.g. a re-run); nothing to write
+                    continue
+                self._hashes[mid] = digest
+                self._by_id[mid] = batch[mid]
+                self._pending.append(data)
+                changed = True
+            if not changed:
+                return
+            self._snapshot = None
+        self._schedule_flush()
 
     def overwrite_all(self, items: Iterable[Dict[str, object]]) -> None:
-        with self._lock:
-            emails: Dict[str, Dict[str, object]] = {}
-            for it in items:
-                mid = str(it.get("id") or "").strip()
-                if mid:
-                    emails[mid] = it
-            self._atomic_write({"emails": emails})
+        emails: Dict[str, Dict[str, object]] = {}
+        for it in items:
+            mid = str(it.get("id") or "").strip()
+            if mid:
+                emails[mid] = it
+        # Rare (reset/import): rewrite synchronously, ordered after queued appends
+        with self._flush_lock:
+            with self._lock:
+                self._by_id = emails
+                self._hashes = {}
+                self._pending = []
+                self._snapshot = None
+            self._atomic_write(emails.values())
+
+    def flush(self) -> None:
+        """Write any pending upserts to disk now."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if pending:
+                self._append(pending)
+            if self._lines >= COMPACT_MIN_LINES and self._lines > 2 * len(self._by_id):
+                self._compact()
 
     # ------------ Internals ------------
-    def _read_json(self) -> dict:
-        with self.path.open("r", encoding="utf-8") as f:
-            return json.load(f)
-
-    def _atomic_write(self, data: dict) -> None:
-        tmp_dir = str(self.path.parent)
-        with NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=tmp_dir, prefix=self.path.stem + ".", suffix=".tmp") as tf:
-            tmp_name = tf.name
-            json.dump(data, tf, ensure_ascii=False, indent=2)
-            tf.flush()
-            os.fsync(tf.fileno())
-        os.replace(tmp_name, self.path)
+    def _view(self) -> Mapping[str, Dict[str, object]]:
+        # Writers only mark the snapshot stale (keeping upserts O(batch) under
+        # the lock); the O(N) copy happens here, once per burst of writes
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self._snapshot = MappingProxyType(dict(self._by_id))
+        return snapshot
+
+    def _recover(self) -> None:
+        with self._flush_lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        # Caller holds self._flush_lock; the snapshot includes anything still pending
+        with self._lock:
+            snapshot = list(self._by_id.values())
+            self._pending = []
+        self._atomic_write(snapshot)
+
+    def _load_jsonl(self, path: Path) -> bool:
+        """Read a JSON Lines file into the index; True if it needs rewriting."""
+        torn = False
+        legacy = False
+        with path.open("rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            # Parse straight from a read-only mapping: no whole-file read and
+            # no decode to str (orjson/json take the UTF-8 bytes directly)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in _iter_lines(mm):
+                    try:
+                        it = loads(line)
+                    except ValueError:
+                        if self._lines == 0 and not self._by_id:
+                            # Not JSON Lines: a legacy pretty-printed {"emails": {...}} file
+                            legacy = True
+                            break
+                        # Torn write; skip the line
+                        torn = True
+                        continue
+                    self._lines += 1
+                    mid = str(it.get("id") or "").strip() if isinstance(it, dict) else ""
+                    if mid:
+                        self._by_id[mid] = it
+                        # Matches _encode() output when the line was written by this store
+                        self._hashes[mid] = hash(line + b"\n")
+        if legacy:
+            # Read after the mapping is closed so the file can be replaced (Windows)
+            self._import_legacy(path)
+            torn = True
+        return torn
+
+    def _load_msgpack(self) -> bool:
+        """Read a MessagePack stream into the index; True if it needs rewriting."""
+        size = self.path.stat().st_size
+        with self.path.open("rb") as f:
+            unpacker = msgpack.Unpacker(f, raw=False)
+            try:
+                for it in unpacker:
+                    self._lines += 1
+                    mid = str(it.get("id") or "").strip() if isinstance(it, dict) else ""
+                    if mid:
+                        self._by_id[mid] = it
+            except ValueError:
+                # Corrupt record; keep what was read before it
+                return True
+            # The unpacker stops before a truncated trailing record (torn write)
+            return unpacker.tell() != size
+
+    def _import_legacy(self, legacy: Optional[Path] = None) -> None:
+        legacy = legacy or self.path.with_suffix(".json")
+        if not legacy.exists():
+            return
+        try:
+            with legacy.open("r", encoding="utf-8") as f:
+                data = loads(f.read())
+        except Exception:
+            return
+        emails = data.get("emails", {}) if isinstance(data, dict) else {}
+        if isinstance(emails, dict):
+            self._by_id = {str(k): v for k, v in emails.items() if isinstance(v, dict)}
+
+    def _encode(self, item: Dict[str, object]) -> bytes:
+        if self._binary:
+            return msgpack.packb(item, use_bin_type=True)
+        return (dumps(item) + "\n").encode("utf-8")
+
+    def _append(self, records: List[bytes]) -> None:
+        self._lines += append_lines(self.path, records, durable=True)
+
+    def _atomic_write(self, items: Iterable[Dict[str, object]]) -> None:
+        self._lines = atomic_write(self.path, (self._encode(it) for it in items), durable=True)
@@ -3,79 +3,114 @@ Processed store for tracking Gmail message IDs already classified and persisting
 classified email objects.
 
 Usage:
-    store = ProcessedStore()  # defaults to 'processed_ids.json' and 'processed_emails.json' in CWD
+    store = ProcessedStore()  # defaults to 'processed_ids.jsonl' in CWD and 'processed_classified.jsonl' beside it
     if not store.has(mid):
         store.add_processed(mid)
-    store.save_classified(email_obj)
+    store.save_classified(email_obj)  # or store.save_many_classified(email_objs)
     emails = store.get_all_classified()
 
 Notes:
-    - JSON-backed for simplicity in development.
-    - Atomic writes (temp file + os.replace) to minimize corruption risk.
-    - For production, consider a DB/Redis. See `backup` stub for future SQLite export.
+    - JSON Lines, append-only: one id (or one email object) per line; on load
+      duplicates collapse and the last email for an id wins.
+    - Both files are loaded once; reads are served from memory. Adds mark the
+      immutable frozenset snapshot of the ids stale and the next read rebuilds
+      it once, so reads between bursts of adds never take a lock.
+    - Mutations are queued and a background thread appends them at most every
+      FLUSH_INTERVAL_MS (env, default 200; 0 writes synchronously), so a burst
+      of N updates costs one append + fsync of N small records instead of N
+      full-file rewrites. `flush()` runs at interpreter exit; call `close()`
+      before deleting the files.
+    - Tiered durability: the emails file is fsynced on every append/rewrite;
+      the ids file is derived data (every processed id is also a stored email)
+      so it skips fsync and relies on os.replace atomicity and the OS page
+      cache. A crash can at worst lose recent ids, which only means those
+      messages are classified again and upserted over themselves.
+    - `compact()` rewrites a file atomically (temp file + os.replace); this
+      happens automatically once superseded lines outnumber live records.
+    - Legacy pretty-printed files ({"processed": [...]} ids, a JSON list of
+      emails) are read at the store path or next to it with a .json suffix,
+      and rewritten as JSON Lines.
+    - For production, use STORE_BACKEND=sqlite (sqlite_store.py); `backup` copies this store into it.
 """
 from __future__ import annotations
 
-import json
 import os
 import threading
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import Iterable, List, Set, Dict, Any
+from typing import FrozenSet, Iterable, List, Optional, Set, Dict, Any
 
+try:
+    from .store_base import COMPACT_MIN_LINES, WriteBehindStore, append_lines, atomic_write, dumps, loads  # type: ignore
+except ImportError:  # imported as a top-level module (uvicorn main:app from backend/)
+    from store_base import COMPACT_MIN_LINES, WriteBehindStore, append_lines, atomic_write, dumps, loads  # type: ignore
 
-class ProcessedStore:
-    """JSON-backed store that persists:
 
-    1) processed_ids.json — unique Gmail message IDs already classified
-       Shape: {"processed": ["id1", "id2", ...]}
-    2) processed_emails.json — list of classified email objects
-       Shape: [ { id, subject, body, sender, date, categories, processed_at, ... }, ... ]
+def _encode(rec: Any) -> bytes:
+    return (dumps(rec) + "\n").encode("utf-8")
+
+
+class ProcessedStore(WriteBehindStore):
+    """JSON Lines store that persists:
+
+    1) processed_ids.jsonl — unique Gmail message IDs already classified
+       Shape: one JSON string per line ("id1"\\n"id2"\\n...)
+    2) processed_classified.jsonl — classified email objects
+       Shape: one { id, subject, body, sender, date, categories, processed_at, ... } per line
     """
 
     def __init__(
         self,
-        ids_path: str | os.PathLike[str] = "processed_ids.json",
-        emails_path: str | os.PathLike[str] = "processed_emails.json",
+        ids_path: str | os.PathLike[str] = "processed_ids.jsonl",
+        emails_path: Optional[str | os.PathLike[str]] = None,
         *,
         debug: bool = False,
+        flush_interval_ms: int | None = None,
     ) -> None:
         # IDs store
         self.path = Path(ids_path).resolve()
         self._lock = threading.Lock()
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        if not self.path.exists():
-            self._atomic_write({"processed": []})
+        self._ids: Set[str] = set()
+        self._pending_ids: List[str] = []
+        records = self._load_records(self.path, "processed")
+        self._ids_lines = len(records)
+        # Ids are coerced to str on add, so loading only filters out junk lines
+        self._ids.update(x for x in records if isinstance(x, str) and x)
+        # Immutable copy for lock-free readers; None when stale (see _ids_view)
+        self._ids_snapshot: Optional[FrozenSet[str]] = frozenset(self._ids)
 
-        # Emails store
-        self.emails_path = Path(emails_path).resolve()
+        # Emails store (kept apart from ProcessedEmailsStore's processed_emails.jsonl)
+        self.emails_path = Path(emails_path).resolve() if emails_path else self.path.with_name("processed_classified.jsonl")
         self._emails_lock = threading.Lock()
         self.emails_path.parent.mkdir(parents=True, exist_ok=True)
-        if not self.emails_path.exists():
-            self._atomic_write_emails([])
+        self._emails: Dict[str, Dict[str, Any]] = {}
+        self._pending_emails: List[Dict[str, Any]] = []
+        records = self._load_records(self.emails_path, "emails")
+        self._emails_lines = len(records)
+        for rec in records:
+            mid = str(rec.get("id") or "").strip() if isinstance(rec, dict) else ""
+            if mid:
+                self._emails[mid] = rec
+
+        # Debounced write-behind
+        self._init_write_behind(flush_interval_ms)
 
         if debug:
-            try:
-                ids_count = len(self._read_ids())
-            except Exception:
-                ids_count = 0
-            try:
-                emails_count = len(self._read_emails_list())
-            except Exception:
-                emails_count = 0
+            ids_count = len(self._ids)
+            emails_count = len(self._emails)
             print(f"ProcessedStore startup: {ids_count} ids, {emails_count} emails cached at {self.path.name}, {self.emails_path.name}")
 
     # --------------- Public API ---------------
     def has(self, message_id: str) -> bool:
-        ids = self._read_ids()
-        return message_id in ids
+        snapshot = self._ids_snapshot
+        if snapshot is None:
+            # One O(1) lookup isn't worth rebuilding the snapshot for
+            with self._lock:
+                return message_id in self._ids
+        return message_id in snapshot
 
     def add(self, message_id: str) -> None:
-        with self._lock:
-            ids = self._read_ids()
-            if message_id not in ids:
-                ids.add(message_id)
-                self._write_ids(ids)
+        self.add_many([message_id])
 
     # Alias as requested API
     def add_processed(self, message_id: str) -> None:
@@ -83,111 +118,182 @@ class ProcessedStore:
 
     def add_many(self, list_ids: Iterable[str]) -> None:
         with self._lock:
-            ids = self._read_ids()
-            ids.update(str(x) for x in list_ids if x)
-            self._write_ids(ids)
+            before = len(self._pending_ids)
+            for x in list_ids:
+                mid = str(x) if x else ""
+                if mid and mid not in self._ids:
+                    self._ids.add(mid)
+                    self._pending_ids.append(mid)
+            changed = len(self._pending_ids) != before
+            if changed:
+                # Keep the add O(batch); the next bulk read rebuilds the copy
+                self._ids_snapshot = None
+        if changed:
+            self._schedule_flush()
+
+    def filter_new(self, ids: Iterable[str]) -> List[str]:
+        """Return the ids not processed yet, in input order, in one pass."""
+        known = self._ids_view()
+        return [x for x in ids if x and x not in known]
 
     def get_all(self) -> List[str]:
-        return sorted(self._read_ids())
+        return sorted(self._ids_view())
 
     # -------- Classified emails API --------
     def save_classified(self, email_obj: Dict[str, Any]) -> None:
         """Append or upsert a classified email object (id required).
 
-        The on-disk format is a JSON list. If an existing list contains an
-        object with the same id, it is replaced; otherwise the object is appended.
+        The object is appended as one JSON line; on load the last line for an
+        id wins, so saving an existing id replaces it.
         """
-        mid = str((email_obj or {}).get("id") or "").strip()
-        if not mid:
+        self.save_many_classified([email_obj])
+
+    def save_many_classified(self, items: Iterable[Dict[str, Any]]) -> None:
+        """Upsert many classified email objects under one lock acquisition.
+
+        Mirrors ProcessedEmailsStore.upsert_many; objects without an id are skipped.
+        """
+        batch: Dict[str, Dict[str, Any]] = {}
+        for it in items:
+            mid = str((it or {}).get("id") or "").strip()
+            if mid:
+                batch[mid] = it
+        if not batch:
             return
         with self._emails_lock:
-            emails = self._read_emails_list()
-            replaced = False
-            for i, it in enumerate(emails):
-                if str((it or {}).get("id") or "").strip() == mid:
-                    emails[i] = email_obj
-                    replaced = True
-                    break
-            if not replaced:
-                emails.append(email_obj)
-            self._atomic_write_emails(emails)
+            # dict keeps the original position of a replaced id
+            self._emails.update(batch)
+            self._pending_emails.extend(batch.values())
+        self._schedule_flush()
 
     def get_all_classified(self) -> List[Dict[str, Any]]:
-        return self._read_emails_list()
+        with self._emails_lock:
+            return list(self._emails.values())
+
+    def flush(self) -> None:
+        """Write any pending changes to disk now."""
+        with self._flush_lock:
+            with self._lock:
+                ids, self._pending_ids = self._pending_ids, []
+            with self._emails_lock:
+                emails, self._pending_emails = self._pending_emails, []
+            # Serialize and fsync outside the data locks so readers/writers don't wait
+            if ids:
+                self._ids_lines += self._append(self.path, ids, durable=False)
+            if emails:
+                self._emails_lines += self._append(self.emails_path, emails, durable=True)
+            self._compact_if_fragmented()
+
+    def compact(self) -> None:
+        """Rewrite both files from memory, dropping superseded lines."""
+        with self._flush_lock:
+            self._compact(ids=True, emails=True)
 
     # --------------- Internals ---------------
-    def _read_ids(self) -> Set[str]:
-        try:
-            data = self._read_json()
-            items = data.get("processed", []) if isinstance(data, dict) else []
-            return set(str(x) for x in items if x)
-        except Exception:
-            # Fall back to empty set on any error
-            return set()
+    def _ids_view(self) -> FrozenSet[str]:
+        snapshot = self._ids_snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._ids_snapshot
+                if snapshot is None:
+                    snapshot = self._ids_snapshot = frozenset(self._ids)
+        return snapshot
+
+    def _recover(self) -> None:
+        self.compact()
 
-    def _write_ids(self, ids: Set[str]) -> None:
-        data = {"processed": sorted(ids)}
-        self._atomic_write(data)
+    def _compact_if_fragmented(self) -> None:
+        # Caller holds self._flush_lock
+        ids_stale = self._ids_lines >= COMPACT_MIN_LINES and self._ids_lines > 2 * len(self._ids)
+        emails_stale = self._emails_lines >= COMPACT_MIN_LINES and self._emails_lines > 2 * len(self._emails)
+        if ids_stale or emails_stale:
+            self._compact(ids=ids_stale, emails=emails_stale)
 
-    def _read_json(self) -> dict:
-        with self.path.open("r", encoding="utf-8") as f:
-            return json.load(f)
+    def _compact(self, *, ids: bool, emails: bool) -> None:
+        # Caller holds self._flush_lock; snapshots include anything still pending
+        if ids:
+            # The file is loaded back into a set, so line order doesn't matter
+            with self._lock:
+                snapshot_ids = list(self._ids)
+                self._pending_ids = []
+            self._ids_lines = self._atomic_write(self.path, snapshot_ids, durable=False)
+        if emails:
+            with self._emails_lock:
+                snapshot_emails = list(self._emails.values())
+                self._pending_emails = []
+            self._emails_lines = self._atomic_write(self.emails_path, snapshot_emails, durable=True)
 
-    def _atomic_write(self, data: dict) -> None:
-        """Atomic write using a temp file followed by os.replace.
+    def _load_records(self, path: Path, legacy_key: str) -> List[Any]:
+        """Read JSON Lines records from path, migrating a legacy JSON file.
 
-        This approach works on Windows and POSIX.
+        A legacy file is a single JSON document: a list of records, or a dict
+        holding them under ``legacy_key`` (as a list or an id-keyed dict). It
+        is read from path itself or, if path is missing, from path with a
+        .json suffix, and rewritten to path as JSON Lines.
         """
-        tmp_dir = str(self.path.parent)
-        # NamedTemporaryFile with delete=False for Windows replace
-        with NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=tmp_dir, prefix=self.path.stem + ".", suffix=".tmp") as tf:
-            tmp_name = tf.name
-            json.dump(data, tf, ensure_ascii=False, indent=2)
-            tf.flush()
-            os.fsync(tf.fileno())
-        os.replace(tmp_name, self.path)
-
-    # Emails helpers
-    def _read_emails_list(self) -> List[Dict[str, Any]]:
+        source = path if path.exists() else path.with_suffix(".json")
+        text = ""
+        if source.exists():
+            try:
+                text = source.read_text(encoding="utf-8")
+            except Exception:
+                text = ""
+
+        legacy: Optional[List[Any]] = None
         try:
-            with self.emails_path.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-        except FileNotFoundError:
-            return []
-        except Exception:
-            # If corrupted, be conservative
+            whole = loads(text) if text.strip() else None
+        except ValueError:
+            whole = None
+        if isinstance(whole, list):
+            legacy = whole
+        elif isinstance(whole, dict) and legacy_key in whole:
+            value = whole.get(legacy_key)
+            legacy = list(value.values()) if isinstance(value, dict) else list(value or [])
+
+        if legacy is not None:
+            self._atomic_write(path, legacy, durable=path != self.path)
+            return legacy
+        if source != path:
+            # No usable legacy file; start an empty JSON Lines file
+            self._atomic_write(path, [], durable=path != self.path)
             return []
-        # Support both list (preferred) and legacy dict shape {"emails": {...}}
-        if isinstance(data, list):
-            return [x for x in data if isinstance(x, dict)]
-        if isinstance(data, dict):
-            emails_dict = data.get("emails")
-            if isinstance(emails_dict, dict):
-                return list(emails_dict.values())
-        return []
-
-    def _atomic_write_emails(self, items: List[Dict[str, Any]]) -> None:
-        tmp_dir = str(self.emails_path.parent)
-        with NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=tmp_dir, prefix=self.emails_path.stem + ".", suffix=".tmp") as tf:
-            tmp_name = tf.name
-            json.dump(items, tf, ensure_ascii=False, indent=2)
-            tf.flush()
-            os.fsync(tf.fileno())
-        os.replace(tmp_name, self.emails_path)
 
+        records: List[Any] = []
+        torn = False
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(loads(line))
+            except ValueError:
+                # Torn write; skip the line
+                torn = True
+        if torn:
+            # Rewrite cleanly so later appends don't land on a partial line
+            self._atomic_write(path, records, durable=path != self.path)
+        return records
+
+    def _append(self, path: Path, records: Iterable[Any], *, durable: bool) -> int:
+        return append_lines(path, [_encode(rec) for rec in records], durable=durable)
+
+    def _atomic_write(self, path: Path, records: Iterable[Any], *, durable: bool) -> int:
+        """Atomically replace path with records; returns the number of lines written."""
+        return atomic_write(path, (_encode(rec) for rec in records), durable=durable)
 
 def backup(json_path: str | os.PathLike[str], sqlite_path: str | os.PathLike[str]) -> None:
-    """Backup processed IDs to SQLite (stub).
+    """Copy processed IDs and classified emails from the JSON store into SQLite.
 
-    This is a placeholder for a future implementation that writes the IDs
-    from the JSON store into a SQLite database for durability and queries.
+    Rows already in the database are kept (ids) or replaced (emails), so this
+    is safe to re-run. main.py uses it for the one-time import when switching
+    to STORE_BACKEND=sqlite.
     """
-    # Example future shape:
-    # import sqlite3
-    # conn = sqlite3.connect(sqlite_path)
-    # cur = conn.cursor()
-    # cur.execute("CREATE TABLE IF NOT EXISTS processed (id TEXT PRIMARY KEY)")
-    # ...
-    # conn.commit()
-    # conn.close()
-    pass
+    from sqlite_store import SQLiteProcessedStore  # lazy: JSON backend doesn't need it
+
+    src = ProcessedStore(json_path)
+    try:
+        dst = SQLiteProcessedStore(sqlite_path)
+        dst.add_many(src.get_all())
+        dst.save_many_classified(src.get_all_classified())
+    finally:
+        src.close()
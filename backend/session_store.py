@@ -27,60 +27,134 @@ import json
 import os
 import threading
 from pathlib import Path
-from tempfile import NamedTemporaryFile
 from typing import Any, Dict, Optional
 
+try:
+    import orjson  # type: ignore
+except ImportError:  # optional: stdlib json fallback
+    orjson = None  # type: ignore
+
+
+# Compact JSON by default; STORE_PRETTY_JSON=1 indents the file for debugging
+PRETTY_JSON = os.getenv("STORE_PRETTY_JSON") == "1"
+
+# Temp files for atomic rewrites are opened directly (no mkstemp retry loop)
+_TMP_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+
+def _file_sig(path: Path) -> Optional[tuple]:
+    # os.replace gives the file a new inode, so this changes on every rewrite
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
 
 class SessionStore:
+    """Sessions are cached in memory and reloaded when the file changes.
+
+    Every ``get`` stats the file and re-reads it only if another process (e.g.
+    another uvicorn worker) rewrote it since this one last read or wrote it.
+    ``set``/``delete`` reload under the writer lock before applying their
+    change and writing the whole file back, so they never drop sessions
+    written by other processes.
+    """
+
     def __init__(self, path: str | os.PathLike[str]) -> None:
         self.path = Path(path).resolve()
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self._sig: Optional[tuple] = None
         if not self.path.exists():
             self._atomic_write({"sessions": {}})
+        self._refresh()
 
     def get(self, session_id: str) -> Optional[Dict[str, Any]]:
-        data = self._read_json()
-        sessions = data.get("sessions", {}) if isinstance(data, dict) else {}
-        item = sessions.get(session_id)
-        return item if isinstance(item, dict) else None
+        self._refresh()
+        return self._sessions.get(session_id)
 
     def set(self, session_id: str, payload: Dict[str, Any]) -> None:
-        with self._lock:
-            data = self._read_json()
-            sessions = data.get("sessions", {}) if isinstance(data, dict) else {}
+        with self._write_lock:
+            self._refresh()
+            sessions = dict(self._sessions)
             sessions[session_id] = payload
-            out = {"sessions": sessions}
-            self._atomic_write(out)
+            self._write_sessions(sessions)
 
     def delete(self, session_id: str) -> None:
-        with self._lock:
+        with self._write_lock:
+            self._refresh()
+            if session_id not in self._sessions:
+                return
+            sessions = dict(self._sessions)
+            del sessions[session_id]
+            self._write_sessions(sessions)
+
+    def all_ids(self) -> list[str]:
+        self._refresh()
+        return list(self._sessions.keys())
+
+    def _refresh(self) -> None:
+        if _file_sig(self.path) == self._sig:
+            return
+        with self._reload_lock:
+            sig = _file_sig(self.path)
+            if sig == self._sig:
+                return
             data = self._read_json()
             sessions = data.get("sessions", {}) if isinstance(data, dict) else {}
-            if session_id in sessions:
-                sessions.pop(session_id, None)
-                out = {"sessions": sessions}
-                self._atomic_write(out)
+            # Swap in a new dict so lock-free readers never see a partial load
+            self._sessions = {
+                str(k): v for k, v in (sessions.items() if isinstance(sessions, dict) else []) if isinstance(v, dict)
+            }
+            self._sig = sig
 
-    def all_ids(self) -> list[str]:
-        data = self._read_json()
-        sessions = data.get("sessions", {}) if isinstance(data, dict) else {}
-        return list(sessions.keys())
+    def _write_sessions(self, sessions: Dict[str, Dict[str, Any]]) -> None:
+        # Caller holds _write_lock
+        sig = self._atomic_write({"sessions": sessions})
+        with self._reload_lock:
+            self._sessions = sessions
+            self._sig = sig
 
     def _read_json(self) -> Dict[str, Any]:
         if not self.path.exists():
             return {"sessions": {}}
-        with self.path.open("r", encoding="utf-8") as f:
+        try:
+            raw = self.path.read_bytes()
+            return orjson.loads(raw) if orjson is not None else json.loads(raw)
+        except Exception:
+            return {"sessions": {}}
+
+    def _atomic_write(self, data: Dict[str, Any]) -> tuple:
+        """Write ``data`` via a temp file + rename; returns the new file's signature."""
+        # Serialize in one call (orjson emits UTF-8 bytes directly), then write
+        if orjson is not None:
+            option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if PRETTY_JSON else 0)
+            payload = orjson.dumps(data, option=option)
+        else:
+            payload = json.dumps(
+                data,
+                ensure_ascii=False,
+                indent=2 if PRETTY_JSON else None,
+                separators=None if PRETTY_JSON else (",", ":"),
+            ).encode("utf-8")
+        # Only one writer per process (_write_lock or __init__); the pid keeps workers apart
+        tmp = self.path.with_name(f"{self.path.name}.tmp.{os.getpid()}")
+        fd = os.open(tmp, _TMP_FLAGS, 0o600)
+        try:
             try:
-                return json.load(f)
-            except Exception:
-                return {"sessions": {}}
-
-    def _atomic_write(self, data: Dict[str, Any]) -> None:
-        tmp_dir = str(self.path.parent)
-        with NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=tmp_dir, prefix=self.path.stem + ".", suffix=".tmp") as tf:
-            tmp_name = tf.name
-            json.dump(data, tf, ensure_ascii=False, indent=2)
-            tf.flush()
-            os.fsync(tf.fileno())
-        os.replace(tmp_name, self.path)
+                view = memoryview(payload)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fsync(fd)
+                # rename keeps inode and mtime, so this is the signature after replace
+                st = os.fstat(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp, self.path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
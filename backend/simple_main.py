@@ -2,13 +2,23 @@ from __future__ import annotations
 
 import os
 import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime
 from pathlib import Path
 from typing import Dict, List, Optional, Annotated
 
 from fastapi import FastAPI, Response, Request, HTTPException, Header
 from fastapi.responses import RedirectResponse, JSONResponse
+
+try:
+    import orjson  # type: ignore  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:  # optional: fall back to the stdlib json encoder
+    DefaultResponse = JSONResponse  # type: ignore
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 import sys
 from pathlib import Path
@@ -19,9 +29,10 @@ if str(ROOT_DIR) not in sys.path:
     sys.path.insert(0, str(ROOT_DIR))
 
 try:
-    from ai_model.inference import EmailClassifier  # type: ignore
+    from ai_model.inference import EmailClassifier, BatchedEmailClassifier  # type: ignore
 except Exception as e:  # pragma: no cover - import-time guard
     EmailClassifier = None  # type: ignore
+    BatchedEmailClassifier = None  # type: ignore
 
 # OAuth dependencies
 from typing import TYPE_CHECKING, Any
@@ -31,12 +42,24 @@ except Exception:
     GoogleFlow = None  # type: ignore
 
 import requests  # type: ignore
+try:
+    import httpx  # type: ignore
+except ImportError:  # optional: pooled requests.Session in a worker thread instead
+    httpx = None  # type: ignore
+try:
+    from cachetools import TTLCache  # type: ignore
+except ImportError:  # optional: small built-in TTL map below
+    TTLCache = None  # type: ignore
 from dotenv import load_dotenv
 from session_store import SessionStore
 
 load_dotenv()
 
-app = FastAPI(title="Email Classification API (Transformers)", version="0.2.0")
+app = FastAPI(
+    title="Email Classification API (Transformers)",
+    version="0.2.0",
+    default_response_class=DefaultResponse,
+)
 # CORS: when sending cookies (withCredentials), we must NOT use '*'.
 _default_origins = [
     os.getenv("FRONTEND_URL") or "http://localhost:3000",
@@ -68,15 +91,60 @@ class EmailBatchInput(BaseModel):
     emails: List[EmailInput]
 
 
-# In-memory session store for demo only. Replace with DB/Redis for production.
-SESSIONS: Dict[str, Dict[str, object]] = {}
+# Sessions are kept in memory by SessionStore and written through to JSON (dev only).
+# Replace with DB/Redis for production.
 SESSION_JSON_PATH = os.getenv("SESSION_STORE_PATH")
 if SESSION_JSON_PATH:
     SESSION_JSON_PATH = Path(SESSION_JSON_PATH)
 else:
     SESSION_JSON_PATH = Path(__file__).resolve().parent / "session_store.json"
 SESSION_STORE = SessionStore(SESSION_JSON_PATH)  # type: ignore[arg-type]
-OAUTH_STATES: Dict[str, str] = {}
+
+# Pending OAuth state -> session id. Abandoned logins would otherwise pile up
+# forever, so entries expire after OAUTH_STATE_TTL_SECONDS and the map is capped.
+OAUTH_STATE_TTL_SECONDS = 600
+OAUTH_STATE_MAXSIZE = 10_000
+
+
+class _TTLStates:
+    """Minimal stand-in for cachetools.TTLCache (get / pop / item assignment).
+
+    Every entry gets the same TTL, so insertion order is expiry order and
+    stale or overflow entries are dropped from the front on each insert.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+    def __setitem__(self, key: str, value: str) -> None:
+        now = time.monotonic()
+        self._items.pop(key, None)
+        while self._items:
+            expires, _ = next(iter(self._items.values()))
+            if expires > now and len(self._items) < self.maxsize:
+                break
+            self._items.popitem(last=False)
+        self._items[key] = (now + self.ttl, value)
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        item = self._items.get(key)
+        if item is None or item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+    def pop(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        item = self._items.pop(key, None)
+        if item is None or item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+
+if TTLCache is not None:
+    OAUTH_STATES = TTLCache(maxsize=OAUTH_STATE_MAXSIZE, ttl=OAUTH_STATE_TTL_SECONDS)
+else:
+    OAUTH_STATES = _TTLStates(OAUTH_STATE_MAXSIZE, OAUTH_STATE_TTL_SECONDS)
 
 
 def _get_env(name: str, required: bool = True) -> Optional[str]:
@@ -115,9 +183,11 @@ def _build_google_flow() -> Any:
 
 # Global classifier instance
 classifier = None
+# Merges concurrent /predict calls into one forward pass
+batched_classifier = None
 
 def load_classifier():
-    """Load the AI model classifier on startup."""
+    """Load the AI model weights (at import with PRELOAD_MODEL=1, else on startup)."""
     global classifier
     # Allow override via env; default to repo's ai_model/email_classification_model
     model_dir = os.getenv("MODEL_PATH")
@@ -127,14 +197,41 @@ def load_classifier():
         raise RuntimeError("Failed to import EmailClassifier from ai_model.inference")
     classifier = EmailClassifier(model_dir)
 
-@app.on_event("startup")
-async def startup() -> None:
+def _set_memory_env() -> None:
     # Set environment variables for memory optimization on Render
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
     os.environ["OMP_NUM_THREADS"] = "1"
+
+
+# Every uvicorn worker process loads its own copy of the model (hundreds of MB
+# of torch/tokenizer state), so RSS grows by one model per extra worker.
+# SINGLE_PROCESS=1 pins `python simple_main.py` to one worker and relies on
+# async + request batching for concurrency (the uvicorn CLI takes --workers). PRELOAD_MODEL=1 loads the model at import
+# time instead of in the startup hook, so a forking server that imports the
+# app before forking (gunicorn --preload) shares the weights copy-on-write.
+# Only the weights are preloaded: the batcher and the store flush threads are
+# started in each worker, since threads don't survive fork(). uvicorn's own
+# --workers spawn fresh interpreters and don't benefit; the cost is a slower
+# import, paid again on every --reload.
+SINGLE_PROCESS = os.getenv("SINGLE_PROCESS") == "1"
+PRELOAD_MODEL = os.getenv("PRELOAD_MODEL") == "1"
+
+# Not when run as a script: main:app re-imports this module as simple_main
+if PRELOAD_MODEL and __name__ != "__main__":
+    _set_memory_env()
     load_classifier()
 
 
+@app.on_event("startup")
+async def startup() -> None:
+    global batched_classifier
+    if classifier is None:
+        _set_memory_env()
+        load_classifier()
+    # Runs in each worker (after any fork), so the batcher thread belongs to it
+    batched_classifier = BatchedEmailClassifier(classifier)
+
+
 @app.get("/health")
 async def health() -> dict:
     return {"status": "ok"}
@@ -158,10 +255,14 @@ async def predict_info() -> dict:
 @app.post("/predict", response_model=List[str])
 async def predict(payload: EmailInput) -> List[str]:
     """Predict email categories using AI model - strict mode, no fallbacks."""
-    if classifier is None:
+    if classifier is None or batched_classifier is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
-    result = classifier.predict(payload.subject, payload.body, top_k=2)
+    # Run off the event loop so concurrent requests can be batched together
+    try:
+        result = await run_in_threadpool(batched_classifier.predict, payload.subject, payload.body, 2)
+    except FuturesTimeoutError:
+        raise HTTPException(status_code=504, detail="Model timed out")
     if not result.get("success"):
         raise HTTPException(status_code=500, detail=f"Model error: {result.get('error')}")
     
@@ -205,6 +306,30 @@ async def predict_batch(payload: EmailBatchInput) -> List[List[str]]:
 
 
 # ------------------ OAuth2: Gmail login ------------------
+USERINFO_URL = "https://openidconnect.googleapis.com/v1/userinfo"
+# Keep-alive clients shared across callbacks so repeat logins reuse the TLS connection
+HTTP_CLIENT = httpx.AsyncClient(timeout=10) if httpx is not None else None
+HTTP_SESSION = requests.Session()
+
+
+async def _fetch_userinfo(access_token: str) -> Dict[str, Any]:
+    """Return the OpenID userinfo for a token, or {} if Google rejects it."""
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if HTTP_CLIENT is not None:
+        resp = await HTTP_CLIENT.get(USERINFO_URL, headers=headers)
+        return resp.json() if resp.is_success else {}
+    # requests is blocking: keep it off the event loop
+    resp = await run_in_threadpool(HTTP_SESSION.get, USERINFO_URL, headers=headers, timeout=10)
+    return resp.json() if resp.ok else {}
+
+
+@app.on_event("shutdown")
+async def close_http_clients() -> None:
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+    HTTP_SESSION.close()
+
+
 @app.get("/auth/login")
 async def auth_login() -> Response:
     try:
@@ -235,19 +360,10 @@ async def auth_callback(request: Request) -> Response:
             raise HTTPException(status_code=400, detail="Invalid state")
 
         flow = _build_google_flow()
-        # Complete the OAuth flow: exchange code for tokens
-        flow.fetch_token(code=code)
+        # Complete the OAuth flow: exchange code for tokens (blocking HTTP, so off the loop)
+        await run_in_threadpool(flow.fetch_token, code=code)
         creds = flow.credentials
 
-        # Fetch user info
-        userinfo_resp = requests.get(
-            "https://openidconnect.googleapis.com/v1/userinfo",
-            headers={"Authorization": f"Bearer {creds.token}"},
-            timeout=10,
-        )
-        userinfo = userinfo_resp.json() if userinfo_resp.ok else {}
-
-        # Save session
         expiry: Optional[str] = None
         try:
             if getattr(creds, "expiry", None):
@@ -255,19 +371,23 @@ async def auth_callback(request: Request) -> Response:
         except Exception:
             expiry = None
 
-        SESSIONS[session_id] = {
+        session = {
             "access_token": creds.token,
             "refresh_token": getattr(creds, "refresh_token", None),
             "expiry": expiry,
             "scopes": creds.scopes,
-            "email": userinfo.get("email"),
-            "name": userinfo.get("name"),
-            "picture": userinfo.get("picture"),
         }
 
-        # Persist session for dev (JSON) and clean the used state
+        userinfo = await _fetch_userinfo(creds.token)
+
+        # Persist the full session for dev (JSON) in one write and clean the used state
         OAUTH_STATES.pop(state, None)
-        SESSION_STORE.set(session_id, SESSIONS[session_id])
+        session.update(
+            email=userinfo.get("email"),
+            name=userinfo.get("name"),
+            picture=userinfo.get("picture"),
+        )
+        await run_in_threadpool(SESSION_STORE.set, session_id, session)
 
         # Redirect to frontend with access_token and user email in URL (dev convenience)
         # Note: For production, avoid passing tokens via URL; rely on HttpOnly cookies or server-side sessions instead.
@@ -296,7 +416,7 @@ async def auth_callback(request: Request) -> Response:
 @app.get("/auth/status")
 async def auth_status(request: Request) -> dict:
     session_id = request.cookies.get("session_id")
-    sess = SESSIONS.get(session_id or "") or (SESSION_STORE.get(session_id or "") if session_id else None)
+    sess = SESSION_STORE.get(session_id) if session_id else None
     if not sess:
         return {"loggedIn": False, "logged_in": False}
     return {
@@ -314,7 +434,6 @@ async def auth_status(request: Request) -> dict:
 async def auth_logout(request: Request) -> Response:
     session_id = request.cookies.get("session_id")
     if session_id:
-        SESSIONS.pop(session_id, None)
         SESSION_STORE.delete(session_id)
     resp = JSONResponse({"ok": True})
     resp.delete_cookie("session_id")
@@ -333,23 +452,40 @@ async def clear_user_data(authorization: Annotated[str | None, Header()] = None)
         
         # Clear in-memory cache
         main_module.PROCESSED_ITEMS.clear()
+        main_module.PROCESSED_ITEMS_INDEX.clear()
+        
+        # Clear backend stores
+        ids_path = main_module.STORE_PATH
+        emails_path = main_module.EMAILS_STORE_PATH
+        sqlite_backend = main_module.STORE_BACKEND == "sqlite"
         
-        # Clear backend JSON stores
-        DATA_DIR = Path(__file__).resolve().parent
-        ids_path = DATA_DIR / "processed_ids.json"
-        emails_path = DATA_DIR / "processed_emails.json"
+        if sqlite_backend:
+            main_module.STORE.clear()
+            main_module.EMAILS_STORE.clear()
+        else:
+            # Stop the old stores' background flushers so they can't rewrite the files
+            main_module.STORE.close()
+            main_module.EMAILS_STORE.close()
         
-        # Delete files if they exist
-        if ids_path.exists():
-            os.remove(ids_path)
-        if emails_path.exists():
-            os.remove(emails_path)
+        # Delete JSON files if they exist (including pre-JSONL .json files); with
+        # the sqlite backend this keeps them from being re-imported later
+        for path in (
+            ids_path,
+            ids_path.with_suffix(".json"),
+            ids_path.with_name("processed_classified.jsonl"),
+            emails_path,
+            emails_path.with_suffix(".json"),
+            emails_path.with_suffix(".jsonl"),  # import source for a .mpk store
+        ):
+            if path.exists():
+                os.remove(path)
         
-        # Reinitialize empty stores in main module
-        from processed_store import ProcessedStore
-        from processed_emails_store import ProcessedEmailsStore
-        main_module.STORE = ProcessedStore(ids_path)
-        main_module.EMAILS_STORE = ProcessedEmailsStore(emails_path)
+        if not sqlite_backend:
+            # Reinitialize empty stores in main module
+            from processed_store import ProcessedStore
+            from processed_emails_store import ProcessedEmailsStore
+            main_module.STORE = ProcessedStore(ids_path)
+            main_module.EMAILS_STORE = ProcessedEmailsStore(emails_path)
         
         return JSONResponse({"success": True, "message": "User data cleared"})
     except Exception as e:
@@ -359,4 +495,15 @@ async def clear_user_data(authorization: Annotated[str | None, Header()] = None)
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Serve main:app (this module's routes plus main.py's) whatever the worker
+    # count. SINGLE_PROCESS/WEB_CONCURRENCY only apply to this launcher; with
+    # the uvicorn CLI pass --workers (it reads WEB_CONCURRENCY itself).
+    workers = 1 if SINGLE_PROCESS else int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1 and os.getenv("STORE_BACKEND", "json").strip().lower() != "sqlite":
+        # The JSON stores live in each worker's memory and rewrite the shared
+        # files on compaction, so workers would drop each other's records
+        import warnings
+
+        warnings.warn("WEB_CONCURRENCY>1 needs STORE_BACKEND=sqlite; starting one worker")
+        workers = 1
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
@@ -0,0 +1,176 @@
+"""
+SQLite-backed drop-in replacements for ProcessedStore and ProcessedEmailsStore.
+
+Enabled in main.py with STORE_BACKEND=sqlite. Both classes share one database
+file (PROCESSED_DB_PATH, default backend/processed.db):
+
+    processed(id TEXT PRIMARY KEY)                                 -- ProcessedStore ids
+    classified(id TEXT PRIMARY KEY, data TEXT, processed_at TEXT)  -- ProcessedStore emails
+    emails(id TEXT PRIMARY KEY, data TEXT, processed_at TEXT)      -- ProcessedEmailsStore
+
+Notes:
+- WAL journal with synchronous=NORMAL: an upsert is a B-tree write plus a WAL
+  append instead of a file rewrite, and readers don't block the writer.
+- One shared connection (check_same_thread=False) guarded by a lock.
+- Email objects are stored as JSON text; the JSON stores remain the
+  import/export format (see processed_store.backup).
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+try:
+    from .store_base import dumps as _dumps, loads as _loads  # type: ignore
+except ImportError:  # imported as a top-level module (uvicorn main:app from backend/)
+    from store_base import dumps as _dumps, loads as _loads  # type: ignore
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS classified (id TEXT PRIMARY KEY, data TEXT NOT NULL, processed_at TEXT);
+CREATE TABLE IF NOT EXISTS emails (id TEXT PRIMARY KEY, data TEXT NOT NULL, processed_at TEXT);
+"""
+
+# Keeps rowid (and so insertion order) when an existing id is replaced
+_UPSERT = (
+    "INSERT INTO {table} (id, data, processed_at) VALUES (?, ?, ?) "
+    "ON CONFLICT(id) DO UPDATE SET data = excluded.data, processed_at = excluded.processed_at"
+)
+
+
+class _SQLiteDB:
+    """Shared connection + lock for one database file."""
+
+    def __init__(self, path: str | os.PathLike[str]) -> None:
+        self.path = Path(path).resolve()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+
+def _email_rows(items: Iterable[Dict[str, Any]]) -> List[tuple]:
+    # Last object per id wins, like the JSON stores
+    batch: Dict[str, Dict[str, Any]] = {}
+    for it in items:
+        mid = str((it or {}).get("id") or "").strip()
+        if mid:
+            batch[mid] = it
+    return [(mid, _dumps(it), it.get("processed_at")) for mid, it in batch.items()]
+
+
+class SQLiteProcessedStore:
+    """Same API as ProcessedStore, backed by the ``processed``/``classified`` tables."""
+
+    def __init__(self, db_path: str | os.PathLike[str] = "processed.db") -> None:
+        self._db = _SQLiteDB(db_path)
+        self.path = self._db.path
+
+    # --------------- Public API ---------------
+    def has(self, message_id: str) -> bool:
+        with self._db.lock:
+            row = self._db.conn.execute("SELECT 1 FROM processed WHERE id = ? LIMIT 1", (message_id,)).fetchone()
+        return row is not None
+
+    def add(self, message_id: str) -> None:
+        self.add_many([message_id])
+
+    # Alias as requested API
+    def add_processed(self, message_id: str) -> None:
+        self.add(message_id)
+
+    def add_many(self, list_ids: Iterable[str]) -> None:
+        rows = [(str(x),) for x in list_ids if x]
+        if not rows:
+            return
+        with self._db.lock, self._db.conn:
+            self._db.conn.executemany("INSERT OR IGNORE INTO processed (id) VALUES (?)", rows)
+
+    def filter_new(self, ids: Iterable[str]) -> List[str]:
+        """Return the ids not processed yet, in input order."""
+        ids = [x for x in ids if x]
+        known: set = set()
+        with self._db.lock:
+            # Stay under SQLite's bound-parameter limit
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                known.update(r[0] for r in self._db.conn.execute(f"SELECT id FROM processed WHERE id IN ({marks})", chunk))
+        return [x for x in ids if x not in known]
+
+    def get_all(self) -> List[str]:
+        with self._db.lock:
+            return [r[0] for r in self._db.conn.execute("SELECT id FROM processed ORDER BY id")]
+
+    # -------- Classified emails API --------
+    def save_classified(self, email_obj: Dict[str, Any]) -> None:
+        self.save_many_classified([email_obj])
+
+    def save_many_classified(self, items: Iterable[Dict[str, Any]]) -> None:
+        rows = _email_rows(items)
+        if not rows:
+            return
+        with self._db.lock, self._db.conn:
+            self._db.conn.executemany(_UPSERT.format(table="classified"), rows)
+
+    def get_all_classified(self) -> List[Dict[str, Any]]:
+        with self._db.lock:
+            rows = self._db.conn.execute("SELECT data FROM classified ORDER BY rowid").fetchall()
+        return [_loads(r[0]) for r in rows]
+
+    def clear(self) -> None:
+        """Delete all processed ids and classified emails."""
+        with self._db.lock, self._db.conn:
+            self._db.conn.execute("DELETE FROM processed")
+            self._db.conn.execute("DELETE FROM classified")
+
+    # Writes are committed immediately; kept for API parity with ProcessedStore
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteProcessedEmailsStore:
+    """Same API as ProcessedEmailsStore, backed by the ``emails`` table."""
+
+    def __init__(self, db_path: str | os.PathLike[str] = "processed.db") -> None:
+        self._db = _SQLiteDB(db_path)
+        self.path = self._db.path
+
+    def get_all(self) -> List[Dict[str, object]]:
+        with self._db.lock:
+            rows = self._db.conn.execute("SELECT data FROM emails ORDER BY rowid").fetchall()
+        return [_loads(r[0]) for r in rows]
+
+    def get(self, message_id: str) -> Optional[Dict[str, object]]:
+        with self._db.lock:
+            row = self._db.conn.execute("SELECT data FROM emails WHERE id = ?", (str(message_id),)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def upsert(self, item: Dict[str, object]) -> None:
+        self.upsert_many([item])
+
+    def upsert_many(self, items: Iterable[Dict[str, object]]) -> None:
+        rows = _email_rows(items)
+        if not rows:
+            return
+        with self._db.lock, self._db.conn:
+            self._db.conn.executemany(_UPSERT.format(table="emails"), rows)
+
+    def overwrite_all(self, items: Iterable[Dict[str, object]]) -> None:
+        rows = _email_rows(items)
+        with self._db.lock, self._db.conn:
+            self._db.conn.execute("DELETE FROM emails")
+            self._db.conn.executemany(_UPSERT.format(table="emails"), rows)
+
+    def clear(self) -> None:
+        self.overwrite_all([])
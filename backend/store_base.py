@@ -0,0 +1,165 @@
+"""
+Shared plumbing for the JSON Lines stores (processed_store, processed_emails_store).
+
+- dumps/loads: compact JSON via orjson when installed, stdlib json otherwise
+  (also used by sqlite_store for its JSON columns).
+- append_lines/atomic_write: binary appends and temp file + os.replace
+  rewrites, so there is no newline translation on any platform.
+- WriteBehindStore: debounced write-behind. Mutations call
+  ``_schedule_flush()``; a daemon thread calls ``flush()`` at most every
+  FLUSH_INTERVAL_MS (env, default 200; 0 writes synchronously). The thread is
+  started on first use in each process, so stores created before a fork
+  (gunicorn --preload) still flush in every worker.
+"""
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # optional: stdlib json fallback
+    orjson = None  # type: ignore
+
+
+def dumps(obj: object) -> str:
+    # One compact JSON document; orjson is several times faster when installed
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def loads(data: str | bytes) -> object:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# fdatasync skips the inode timestamp update that fsync also flushes (POSIX only)
+fsync = getattr(os, "fdatasync", os.fsync)
+
+FLUSH_INTERVAL_MS = int(os.getenv("FLUSH_INTERVAL_MS", "200"))
+
+# Don't bother compacting small files
+COMPACT_MIN_LINES = 1000
+
+# Temp files for atomic rewrites are opened directly (no mkstemp retry loop)
+# and written in binary, so Windows never translates newlines
+_TMP_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+
+def _tmp_path(path: Path) -> Path:
+    # Unique per process and thread, so concurrent writers never share a temp file
+    return path.with_name(f"{path.name}.tmp.{os.getpid()}.{threading.get_ident()}")
+
+
+def append_lines(path: Path, records: Iterable[bytes], *, durable: bool) -> int:
+    """Append already-encoded records to path; returns how many were written."""
+    records = list(records)
+    with path.open("ab") as f:
+        f.write(b"".join(records))
+        if durable:
+            f.flush()
+            fsync(f.fileno())
+    return len(records)
+
+
+def atomic_write(path: Path, records: Iterable[bytes], *, durable: bool) -> int:
+    """Replace path with the encoded records via a temp file and os.replace.
+
+    This works on Windows and POSIX. With ``durable=False`` the temp file is
+    not fsynced (os.replace still swaps it in atomically). Returns the number
+    of records written.
+    """
+    tmp = _tmp_path(path)
+    count = 0
+    try:
+        with open(os.open(tmp, _TMP_FLAGS, 0o600), "wb") as f:
+            for rec in records:
+                f.write(rec)
+                count += 1
+            if durable:
+                f.flush()
+                fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return count
+
+
+class WriteBehindStore:
+    """Base class for stores that queue mutations and flush them in the background.
+
+    Subclasses call ``_init_write_behind`` from ``__init__``, implement
+    ``flush()`` (taking ``self._flush_lock``) and ``_recover()``, which rewrites
+    the files from memory after a failed flush.
+    """
+
+    def _init_write_behind(self, flush_interval_ms: Optional[int]) -> None:
+        interval_ms = FLUSH_INTERVAL_MS if flush_interval_ms is None else flush_interval_ms
+        self._flush_interval = max(0, interval_ms) / 1000.0
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        # The flush thread starts on first use, so a process that imports the
+        # store and then forks (gunicorn --preload) gets one per worker
+        self._flusher_pid: Optional[int] = None
+        self._flusher_lock = threading.Lock()
+        if self._flush_interval > 0:
+            atexit.register(self.flush)
+
+    def flush(self) -> None:
+        raise NotImplementedError
+
+    def _recover(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Flush pending changes and stop the background flusher."""
+        self.flush()
+        self._closed = True
+        self._wakeup.set()
+        if self._flush_interval > 0:
+            atexit.unregister(self.flush)
+
+    def _schedule_flush(self) -> None:
+        # Called without the data locks held; with no debounce, write through now
+        if self._flush_interval <= 0:
+            self.flush()
+        else:
+            self._ensure_flusher()
+            self._wakeup.set()
+
+    def _ensure_flusher(self) -> None:
+        # Threads don't survive fork(): start one whenever this process has none
+        if self._flusher_pid == os.getpid():
+            return
+        with self._flusher_lock:
+            if self._flusher_pid != os.getpid():
+                name = f"{type(self).__name__}-flush"
+                threading.Thread(target=self._flush_loop, name=name, daemon=True).start()
+                self._flusher_pid = os.getpid()
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._wakeup.wait()
+            if self._closed:
+                return
+            # Let a burst of mutations accumulate, then write once
+            time.sleep(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # The failed batch left the queue; a full rewrite from memory restores it
+                print(f"{type(self).__name__} flush failed: {e}")
+                try:
+                    self._recover()
+                except Exception:
+                    pass